@@ -0,0 +1,142 @@
+"""
+物品特征列式快照
+每天导出一次全量物品特征，每列一个.npy文件，按item_id排序存放：
+
+    <root>/
+        current -> 20240101T000000/     # 指向当前快照的符号链接，原子替换
+        20240101T000000/
+            manifest.json              # 列名、物品数
+            item_ids.npy               # 排序后的item_id
+            total_clicks.npy ...       # 每列一个文件
+
+API进程以mmap方式打开，多个uvicorn worker通过页缓存共享同一份数据；
+按id查找用二分查找，不需要在每个进程中构建索引字典。
+
+从item_stats的parquet导出（默认只导出API读取的物品特征列）：
+    python item_snapshot.py <item_stats.parquet> <root> [列名 ...]
+"""
+
+import json
+import os
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+MANIFEST_FILE = "manifest.json"
+ITEM_IDS_FILE = "item_ids.npy"
+CURRENT_LINK = "current"
+# API读取的物品特征列，与main.py的ITEM_FEATURE_NAMES一致；快照命中和Feast回源返回相同的字段
+DEFAULT_COLUMNS = ["total_clicks", "total_purchases", "purchase_rate", "popularity_score"]
+
+
+class ItemFeatureSnapshot:
+    """已打开的只读快照，columns不为空时只打开其中的列"""
+
+    def __init__(self, path: str, columns: Optional[List[str]] = None):
+        self.path = os.path.realpath(path)
+        with open(os.path.join(self.path, MANIFEST_FILE), 'r') as f:
+            manifest = json.load(f)
+        self.columns: List[str] = [
+            name for name in manifest['columns'] if columns is None or name in columns
+        ]
+        # np.asarray去掉memmap子类，保留映射但避免子类在每次索引时的额外开销
+        self.item_ids = np.asarray(np.load(os.path.join(self.path, ITEM_IDS_FILE), mmap_mode='r'))
+        self.data: Dict[str, np.ndarray] = {
+            name: np.asarray(np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode='r'))
+            for name in self.columns
+        }
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
+
+    def lookup(self, item_ids: List[str]) -> np.ndarray:
+        """返回每个物品所在的行号，不存在的为-1"""
+        if not item_ids or not len(self.item_ids):
+            return np.full(len(item_ids), -1, dtype=np.int64)
+        query = np.asarray(item_ids)
+        rows = np.searchsorted(self.item_ids, query)
+        rows = np.minimum(rows, len(self.item_ids) - 1)
+        found = self.item_ids[rows] == query
+        return np.where(found, rows, -1)
+
+    def get_many(self, item_ids: List[str]) -> Tuple[Dict[str, Dict], List[str]]:
+        """按列gather命中物品的特征，返回 (物品ID -> 特征字典, 未命中的物品ID)"""
+        rows = self.lookup(item_ids)
+        hit = rows >= 0
+        hit_ids = [item_id for item_id, ok in zip(item_ids, hit) if ok]
+        hit_rows = rows[hit]
+
+        # 每列一次gather，再转成Python值
+        values = [self.data[name][hit_rows].tolist() for name in self.columns]
+        features = {
+            item_id: dict(zip(self.columns, row))
+            for item_id, row in zip(hit_ids, zip(*values))
+        } if hit_ids else {}
+        missing = [item_id for item_id, ok in zip(item_ids, hit) if not ok]
+        return features, missing
+
+
+def current_snapshot_path(root: str) -> Optional[str]:
+    """当前快照目录的真实路径，没有快照时返回None"""
+    link = os.path.join(root, CURRENT_LINK)
+    if not os.path.exists(os.path.join(link, MANIFEST_FILE)):
+        return None
+    return os.path.realpath(link)
+
+
+def write_snapshot(root: str, item_ids, columns: Dict[str, np.ndarray],
+                   version: Optional[str] = None) -> str:
+    """写入新快照并原子地把current指向它，返回快照目录"""
+    version = version or datetime.now().strftime("%Y%m%dT%H%M%S")
+    path = os.path.join(root, version)
+    os.makedirs(path, exist_ok=False)
+
+    item_ids = np.asarray(item_ids, dtype=str)
+    order = np.argsort(item_ids, kind='stable')
+    np.save(os.path.join(path, ITEM_IDS_FILE), item_ids[order])
+    for name, values in columns.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.asarray(values)[order])
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump({'columns': list(columns), 'n_items': int(len(item_ids))}, f)
+
+    # 先建临时链接再rename，读取方不会看到中间状态
+    tmp_link = os.path.join(root, f".{CURRENT_LINK}.{version}")
+    os.symlink(version, tmp_link)
+    os.replace(tmp_link, os.path.join(root, CURRENT_LINK))
+    return path
+
+
+def main(argv: Optional[List[str]] = None):
+    """从item_stats的parquet导出快照（每个物品取最新一行）"""
+    import pandas as pd
+
+    argv = argv if argv is not None else sys.argv[1:]
+    if len(argv) < 2:
+        print("usage: python item_snapshot.py <item_stats.parquet> <snapshot_root> [column ...]")
+        sys.exit(1)
+    names = argv[2:] or DEFAULT_COLUMNS
+
+    df = pd.read_parquet(argv[0])
+    missing = [name for name in names if name not in df.columns]
+    if missing:
+        print(f"Missing columns in {argv[0]}: {', '.join(missing)}")
+        sys.exit(1)
+    if 'event_timestamp' in df.columns:
+        df = df.sort_values('event_timestamp')
+    df = df.drop_duplicates('item_id', keep='last')
+
+    columns = {}
+    for name in names:
+        if pd.api.types.is_numeric_dtype(df[name]):
+            columns[name] = df[name].fillna(0).to_numpy(dtype=np.float32)
+        else:
+            columns[name] = df[name].fillna('').astype(str).to_numpy(dtype=str)
+
+    path = write_snapshot(argv[1], df['item_id'].astype(str).to_numpy(), columns)
+    print(f"Wrote {len(df)} items, {len(columns)} columns to {path}")
+
+
+if __name__ == '__main__':
+    main()
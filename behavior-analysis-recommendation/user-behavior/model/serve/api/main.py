@@ -1,31 +1,47 @@
 import os
 import json
 import logging
+import random
+import struct
+import time
+import zlib
 import numpy as np
 import pandas as pd
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, AsyncIterator, Tuple
 from datetime import datetime, timedelta
 import asyncio
-from contextlib import asynccontextmanager
+import functools
+import heapq
+import itertools
+from collections import Counter as CollectionCounter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
 # FastAPI
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Depends
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 
 # 监控
 from prometheus_client import Counter, Histogram, Gauge, generate_latest
+from prometheus_client.core import GaugeMetricFamily
 import prometheus_client
 
 # 缓存
 import aioredis
 from aioredis import Redis
 
+# 消息队列
+from aiokafka import AIOKafkaProducer
+
 # 模型加载
 import joblib
 import pickle
-import xgboost as xgb
+from tree_scorer import CompiledTreeEnsemble, benchmark_ms, check_parity, parity_matrix
+from vector_index import IVFIndex
+from item_snapshot import ItemFeatureSnapshot, current_snapshot_path
+from sampling_profiler import SamplingProfiler
 
 # 特征存储
 import feast
@@ -48,7 +64,49 @@ class Settings(BaseSettings):
     model_path: str = "/app/models"
     model_name: str = "xgboost"
     model_version: str = "latest"
+    model_max_batch_size: int = 256  # 单次模型调用的最大候选数，设为1即逐个打分
+    model_scorer: str = "auto"  # XGBoost打分方式：native、compiled（纯NumPy）或auto（加载时选更快的）
+    model_watch_interval: float = 30.0  # model_version为latest时检查新版本的间隔（秒），0为不检查
+    model_scoring_max_concurrency: int = 4  # 模型打分线程池大小
+    model_scoring_max_queue: int = 64  # 等待打分线程的最大请求数，超出直接降级
     kafka_broker: str = "localhost:9092"
+    kafka_topic: str = "user-events"
+    kafka_linger_ms: int = 5  # 生产者攒批等待时间
+    kafka_max_batch_size: int = 65536  # 单个分区批次的最大字节数
+    kafka_compression_type: Optional[str] = None  # gzip / snappy / lz4 / zstd
+    impression_batch_size: int = 500  # 每条Kafka消息合并的推荐响应数
+    impression_flush_interval: float = 1.0  # 曝光缓冲区最长刷新间隔（秒）
+    impression_buffer_size: int = 20000  # 曝光缓冲区上限（推荐响应数）
+    impression_overflow_policy: str = "drop"  # 缓冲区满时: drop 丢弃 / block 等待
+    feature_store_max_concurrency: int = 8  # Feast在线读取线程池大小
+    feature_store_max_queue: int = 256  # 等待Feast读取的最大请求数，超出直接降级
+    item_snapshot_path: Optional[str] = None  # 物品特征列式快照目录，未配置时物品特征全部读Feast
+    item_snapshot_watch_interval: float = 60.0  # 检查新快照的间隔（秒），0为不检查
+    category_sim_same: float = 0.8  # MMR品类相似度：同品类
+    category_sim_group: float = 0.5  # MMR品类相似度：同大类（品类前3个字符相同）
+    category_sim_other: float = 0.1  # MMR品类相似度：其他
+    ab_redis_url: str = "redis://localhost:6380"  # AB测试专用Redis
+    ab_flush_interval: float = 1.0  # AB计数默认最长缓冲时间（秒）
+    ab_purchase_flush_delay: float = 0.0  # 购买计数的最长缓冲时间（秒），0为立即写入，转化数据不等待刷新
+    cache_compress_threshold: int = 512  # 推荐缓存编码后超过该字节数时压缩
+    item_sketch_capacity: int = 5000  # 物品曝光/点击统计跟踪的物品数上限
+    item_metrics_top_k: int = 100  # 导出到Prometheus的热门物品数
+    recommend_batch_max_size: int = 500  # 批量推荐接口单次最多用户数
+    recommend_batch_concurrency: int = 16  # 所有批量推荐请求合计同时召回的用户数（每个用户并发多路Redis读取）
+    events_batch_max_size: int = 1000  # 批量事件接口单次最多事件数
+    embedding_recall_size: int = 50  # 向量召回路返回的物品数，0为关闭
+    embedding_index_lists: int = 0  # IVF倒排列表数，0为按物品数自动选择
+    embedding_index_nprobe: int = 8  # 每次查询探测的倒排列表数
+    embedding_index_rebuild_interval: float = 600.0  # 向量索引重建间隔（秒），0为只在启动时构建
+    request_deadline_ms: float = 0.0  # 推荐请求的默认延迟预算（毫秒），0为不限；可用X-Request-Deadline-Ms覆盖
+    budget_share_recall: float = 0.3  # 召回阶段占预算的比例
+    budget_share_features: float = 0.3  # 特征获取阶段占预算的比例
+    budget_share_ranking: float = 0.3  # 模型打分阶段占预算的比例
+    budget_share_diversify: float = 0.1  # 多样性处理阶段占预算的比例
+    admin_token: Optional[str] = None  # 管理接口令牌（X-Admin-Token），未配置时管理接口不可用
+    profile_max_seconds: float = 60.0  # 单次采样分析的最长时间
+    local_cache_size: int = 10000  # 进程内L1缓存的最大条目数
+    local_cache_ttl: float = 60.0  # 进程内L1缓存的过期时间（秒）
 
     class Config:
         env_file = ".env"
@@ -81,6 +139,7 @@ class RecommendationResponse(BaseModel):
     processing_time_ms: float
     model_version: str
     experiment_id: Optional[str] = None
+    degraded_stages: List[str] = []  # 因超出延迟预算而降级的阶段
 
 class TrackEventRequest(BaseModel):
     """跟踪事件"""
@@ -105,22 +164,30 @@ recommendation_latency = Histogram(
     ['page_type']
 )
 
+# 各阶段和各路召回多为亚毫秒到几十毫秒，默认分桶（最小5ms）无法区分
+STAGE_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+recommendation_stage_latency = Histogram(
+    'recommendation_stage_latency_seconds',
+    'Latency of each recommendation pipeline stage',
+    ['stage'],
+    buckets=STAGE_LATENCY_BUCKETS
+)
+
+# 物品级曝光/点击不再作为标签导出（基数过高），由ItemHeavyHitters统计并只导出TopK
 item_impression_counter = Counter(
     'item_impressions_total',
-    'Total item impressions',
-    ['item_id', 'page_type']
+    'Total item impressions'
 )
 
 item_click_counter = Counter(
     'item_clicks_total',
-    'Total item clicks',
-    ['item_id']
+    'Total item clicks'
 )
 
 click_through_rate_gauge = Gauge(
     'click_through_rate',
-    'Click through rate',
-    ['user_id']
+    'Aggregate click through rate since process start'
 )
 
 active_users_gauge = Gauge(
@@ -128,66 +195,646 @@ active_users_gauge = Gauge(
     'Number of active users in last 5 minutes'
 )
 
+recall_route_latency = Histogram(
+    'recall_route_latency_seconds',
+    'Candidate recall latency per route',
+    ['route'],
+    buckets=STAGE_LATENCY_BUCKETS
+)
+
+embedding_index_size = Gauge(
+    'embedding_index_items',
+    'Number of items in the in-memory embedding recall index'
+)
+
+embedding_index_build_seconds = Histogram(
+    'embedding_index_build_seconds',
+    'Time to load item embeddings and rebuild the recall index'
+)
+
+item_snapshot_lookup_counter = Counter(
+    'item_snapshot_lookups_total',
+    'Item feature lookups served from the local snapshot',
+    ['result']
+)
+
+item_snapshot_size = Gauge(
+    'item_snapshot_items',
+    'Number of items in the loaded item feature snapshot'
+)
+
+degraded_stage_counter = Counter(
+    'recommendation_degraded_stages_total',
+    'Pipeline stages degraded to stay within the request deadline',
+    ['stage']
+)
+
+request_backend_reads = Histogram(
+    'recommendation_backend_reads',
+    'Backend reads per uncached recommendation request',
+    ['backend'],
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16)
+)
+
+feature_store_queue_depth = Gauge(
+    'feature_store_queue_depth',
+    'Online feature reads waiting for a feature store worker thread'
+)
+
+feature_store_rejected_counter = Counter(
+    'feature_store_rejected_total',
+    'Online feature reads rejected because the wait queue was full'
+)
+
+model_scoring_rejected_counter = Counter(
+    'model_scoring_rejected_total',
+    'Model scoring calls rejected because the wait queue was full'
+)
+
+kafka_pending_gauge = Gauge(
+    'kafka_producer_pending_messages',
+    'Messages handed to the Kafka producer and not yet acknowledged'
+)
+
+kafka_send_latency = Histogram(
+    'kafka_send_latency_seconds',
+    'Time from handing a message to the Kafka producer until broker acknowledgement'
+)
+
+kafka_send_errors_counter = Counter(
+    'kafka_send_errors_total',
+    'Kafka messages that failed delivery'
+)
+
+impression_buffer_gauge = Gauge(
+    'impression_buffer_records',
+    'Recommendation responses waiting in the impression buffer'
+)
+
+impression_flush_latency = Histogram(
+    'impression_flush_latency_seconds',
+    'Time to hand one impression batch to the Kafka producer'
+)
+
+impressions_dropped_counter = Counter(
+    'impressions_dropped_total',
+    'Impressions dropped because the buffer was full or the flush failed'
+)
+
+model_load_seconds = Histogram(
+    'model_load_seconds',
+    'Time to load a model version from disk'
+)
+
+model_warmup_seconds = Histogram(
+    'model_warmup_seconds',
+    'Time to warm up a newly loaded model version'
+)
+
+model_active_version = Gauge(
+    'model_active_version',
+    'Currently active model version (value is always 1)',
+    ['model_name', 'version']
+)
+
+cache_lookup_counter = Counter(
+    'recommendation_cache_lookups_total',
+    'Recommendation cache lookups',
+    ['layer', 'result']
+)
+
+coalesced_requests_counter = Counter(
+    'recommendation_coalesced_requests_total',
+    'Recommendation requests served by an identical in-flight computation',
+    ['page_type']
+)
+
+class SpaceSavingCounter:
+    """Space-Saving算法：在固定容量内近似统计出现次数最多的元素
+
+    容量满时新元素替换计数最小的元素并继承其计数，因此估计值只会偏高，
+    偏高的上限记录在errors中。
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self._heap: List[tuple] = []  # (计数, 元素)，包含过期条目，按需跳过
+
+    def add(self, key: str, count: int = 1):
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            min_key, min_count = self._pop_min()
+            del self.counts[min_key]
+            del self.errors[min_key]
+            self.counts[key] = min_count + count
+            self.errors[key] = min_count
+
+        heapq.heappush(self._heap, (self.counts[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c, k) for k, c in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                return key, count
+
+    def estimate(self, key: str) -> int:
+        return self.counts.get(key, 0)
+
+    def top(self, k: int) -> List[tuple]:
+        return heapq.nlargest(k, self.counts.items(), key=lambda kv: kv[1])
+
+class ItemHeavyHitters:
+    """物品曝光/点击的固定内存统计，作为Prometheus collector只导出TopK物品"""
+
+    def __init__(self, capacity: int = 5000, top_k: int = 100):
+        self.top_k = top_k
+        self.impressions = SpaceSavingCounter(capacity)
+        self.clicks = SpaceSavingCounter(capacity)
+        self.total_impressions = 0
+        self.total_clicks = 0
+
+    def record(self, action: str, item_id: str, count: int = 1):
+        if action == "impression":
+            self.impressions.add(item_id, count)
+            self.total_impressions += count
+        elif action == "click":
+            self.clicks.add(item_id, count)
+            self.total_clicks += count
+
+    def ctr(self) -> float:
+        """整体点击率"""
+        if not self.total_impressions:
+            return 0.0
+        return self.total_clicks / self.total_impressions
+
+    def collect(self):
+        top_impressions = self.impressions.top(self.top_k)
+
+        impressions = GaugeMetricFamily(
+            'item_impressions_topk', 'Estimated impressions of the top-K items', labels=['item_id']
+        )
+        ctr = GaugeMetricFamily(
+            'item_ctr_topk', 'Estimated click through rate of the top-K items by impressions',
+            labels=['item_id']
+        )
+        for item_id, count in top_impressions:
+            impressions.add_metric([item_id], count)
+            ctr.add_metric([item_id], self.clicks.estimate(item_id) / count)
+        yield impressions
+        yield ctr
+
+        clicks = GaugeMetricFamily(
+            'item_clicks_topk', 'Estimated clicks of the top-K items', labels=['item_id']
+        )
+        for item_id, count in self.clicks.top(self.top_k):
+            clicks.add_metric([item_id], count)
+        yield clicks
+
+    def dump(self) -> Dict:
+        """导出完整统计（离线分析用）"""
+        def sketch(counter: SpaceSavingCounter) -> List[Dict]:
+            return [
+                {"item_id": item_id, "count": count, "error": counter.errors[item_id]}
+                for item_id, count in counter.top(len(counter.counts))
+            ]
+
+        return {
+            "capacity": self.impressions.capacity,
+            "total_impressions": self.total_impressions,
+            "total_clicks": self.total_clicks,
+            "impressions": sketch(self.impressions),
+            "clicks": sketch(self.clicks),
+        }
+
+item_heavy_hitters = ItemHeavyHitters(
+    capacity=settings.item_sketch_capacity,
+    top_k=settings.item_metrics_top_k
+)
+prometheus_client.REGISTRY.register(item_heavy_hitters)
+click_through_rate_gauge.set_function(item_heavy_hitters.ctr)
+
+@contextmanager
+def stage_timer(stage: str):
+    """记录一个流水线阶段的耗时（单调时钟）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recommendation_stage_latency.labels(stage=stage).observe(time.perf_counter() - start)
+
+async def timed_stage(stage: str, coro):
+    """等待协程并记录阶段耗时"""
+    with stage_timer(stage):
+        return await coro
+
 # ============ 缓存和存储 ============
 
+INVALIDATION_CHANNEL = "rec:invalidate"  # 用户缓存失效广播频道
+MODEL_ROLLBACK_CHANNEL = "model:rollback"  # 模型回滚广播频道，消息为被回滚的版本
+MODEL_ROLLED_BACK_KEY = "model:rolled_back:{model_name}"  # 已回滚版本集合，新启动的worker也不会加载
+MODEL_COMPLETE_MARKER = "_SUCCESS"  # 模型版本目录写入完成的标记文件
+
+# 推荐理由
+REASON_RECENT_SIMILAR = "因为您最近浏览过类似商品"
+REASON_POPULAR = "热门推荐"
+REASON_GUESS = "猜你喜欢"
+
+class RecommendationCodec:
+    """推荐缓存的紧凑二进制编码
+
+    格式: MAGIC(1B) | 版本(1B) | 标志(1B) | 载荷（超过阈值时zlib压缩）
+    载荷: 物品数(uint16)，每个物品依次为
+        item_id长度(uint16) + item_id(utf-8) | score(float64) |
+        理由编码(uint8，见KNOWN_REASONS；254后跟长度+原文，255为空) |
+        是否有features(uint8)，有则跟长度(uint32) + JSON
+    KNOWN_REASONS只能在末尾追加，否则需要升级版本号。
+    """
+
+    MAGIC = b"\xa7"  # 与旧版JSON缓存（以'['开头）区分
+    VERSION = 1
+    FLAG_COMPRESSED = 0x01
+    KNOWN_REASONS = [REASON_RECENT_SIMILAR, REASON_POPULAR, REASON_GUESS]
+    _REASON_LITERAL = 254
+    _REASON_NONE = 255
+
+    def __init__(self, compress_threshold: int = 512):
+        self.compress_threshold = compress_threshold
+        self._reason_codes = {reason: i for i, reason in enumerate(self.KNOWN_REASONS)}
+
+    def encode(self, recommendations: List[RecommendationItem]) -> bytes:
+        parts = [struct.pack("<H", len(recommendations))]
+        for item in recommendations:
+            item_id = item.item_id.encode()
+            parts.append(struct.pack("<H", len(item_id)))
+            parts.append(item_id)
+            parts.append(struct.pack("<d", item.score))
+
+            if item.reason is None:
+                parts.append(bytes([self._REASON_NONE]))
+            elif item.reason in self._reason_codes:
+                parts.append(bytes([self._reason_codes[item.reason]]))
+            else:
+                reason = item.reason.encode()
+                parts.append(struct.pack("<BH", self._REASON_LITERAL, len(reason)))
+                parts.append(reason)
+
+            if item.features is None:
+                parts.append(b"\x00")
+            else:
+                features = json.dumps(item.features).encode()
+                parts.append(struct.pack("<BI", 1, len(features)))
+                parts.append(features)
+
+        payload = b"".join(parts)
+        flags = 0
+        if len(payload) >= self.compress_threshold:
+            compressed = zlib.compress(payload, 1)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= self.FLAG_COMPRESSED
+        return self.MAGIC + bytes([self.VERSION, flags]) + payload
+
+    def decode(self, data: bytes) -> List[RecommendationItem]:
+        if data[:1] != self.MAGIC:
+            # 旧版JSON缓存
+            return [RecommendationItem(**item) for item in json.loads(data)]
+
+        version, flags = data[1], data[2]
+        if version != self.VERSION:
+            raise ValueError(f"Unsupported cache format version: {version}")
+        payload = data[3:]
+        if flags & self.FLAG_COMPRESSED:
+            payload = zlib.decompress(payload)
+
+        (count,), offset = struct.unpack_from("<H", payload), 2
+        recommendations = []
+        for _ in range(count):
+            (id_len,) = struct.unpack_from("<H", payload, offset)
+            offset += 2
+            item_id = payload[offset:offset + id_len].decode()
+            offset += id_len
+            (score,) = struct.unpack_from("<d", payload, offset)
+            offset += 8
+
+            reason_code = payload[offset]
+            offset += 1
+            if reason_code == self._REASON_NONE:
+                reason = None
+            elif reason_code == self._REASON_LITERAL:
+                (reason_len,) = struct.unpack_from("<H", payload, offset)
+                offset += 2
+                reason = payload[offset:offset + reason_len].decode()
+                offset += reason_len
+            else:
+                reason = self.KNOWN_REASONS[reason_code]
+
+            features = None
+            has_features = payload[offset]
+            offset += 1
+            if has_features:
+                (features_len,) = struct.unpack_from("<I", payload, offset)
+                offset += 4
+                features = json.loads(payload[offset:offset + features_len])
+                offset += features_len
+
+            # 数据由本服务写入，跳过pydantic校验直接构造
+            recommendations.append(RecommendationItem.construct(
+                item_id=item_id, score=score, reason=reason, features=features
+            ))
+        return recommendations
+
 class RecommendationCache:
-    """推荐结果缓存"""
+    """推荐结果缓存
+
+    值为RecommendationCodec编码的二进制数据，redis_client需以
+    decode_responses=False创建。
+    """
 
-    def __init__(self, redis_client: Redis):
+    def __init__(self, redis_client: Redis, codec: Optional[RecommendationCodec] = None):
         self.redis = redis_client
+        self.codec = codec or RecommendationCodec()
         self.default_ttl = 300  # 5分钟
 
-    async def get_cached_recommendations(self, user_id: str, page_type: str) -> Optional[List[Dict]]:
+    async def get_cached_recommendations(self, user_id: str,
+                                         page_type: str) -> Optional[List[RecommendationItem]]:
         """获取缓存的推荐结果"""
         cache_key = f"rec:{user_id}:{page_type}"
         cached = await self.redis.get(cache_key)
         if cached:
             logger.info(f"Cache hit for user {user_id}")
-            return json.loads(cached)
+            try:
+                return self.codec.decode(cached)
+            except Exception as e:
+                logger.error(f"Error decoding cached recommendations: {e}")
         return None
 
+    async def get_many_cached_recommendations(
+            self, keys: List[Tuple[str, str]]
+    ) -> List[Optional[List[RecommendationItem]]]:
+        """批量获取缓存的推荐结果，keys为 (user_id, page_type) 列表，一次MGET"""
+        if not keys:
+            return []
+        values = await self.redis.mget([f"rec:{user_id}:{page_type}" for user_id, page_type in keys])
+        results = []
+        for cached in values:
+            recommendations = None
+            if cached:
+                try:
+                    recommendations = self.codec.decode(cached)
+                except Exception as e:
+                    logger.error(f"Error decoding cached recommendations: {e}")
+            results.append(recommendations)
+        return results
+
     async def cache_recommendations(self, user_id: str, page_type: str,
-                                   recommendations: List[Dict], ttl: int = None):
-        """缓存推荐结果"""
+                                   recommendations: List[RecommendationItem], ttl: int = None):
+        """缓存推荐结果，并登记到用户的缓存键集合中"""
         cache_key = f"rec:{user_id}:{page_type}"
-        await self.redis.setex(
-            cache_key,
-            ttl or self.default_ttl,
-            json.dumps(recommendations)
-        )
+        index_key = f"rec_keys:{user_id}"
+        ttl = ttl or self.default_ttl
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.setex(cache_key, ttl, self.codec.encode(recommendations))
+        pipe.sadd(index_key, cache_key)
+        pipe.expire(index_key, ttl)
+        await pipe.execute()
 
     async def invalidate_user_cache(self, user_id: str):
-        """失效用户缓存（当用户有新行为时）"""
-        pattern = f"rec:{user_id}:*"
-        keys = await self.redis.keys(pattern)
+        """失效用户缓存（当用户有新行为时）
+
+        通过用户的缓存键集合定位需要删除的键，耗时只与该用户缓存的页面数有关，
+        不扫描整个keyspace。
+        """
+        index_key = f"rec_keys:{user_id}"
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.smembers(index_key)
+        pipe.delete(index_key)
+        keys, _ = await pipe.execute()
         if keys:
             await self.redis.delete(*keys)
             logger.info(f"Invalidated {len(keys)} caches for user {user_id}")
 
+        # 通知所有worker失效进程内缓存
+        await self.redis.publish(INVALIDATION_CHANNEL, user_id)
+
+class LocalRecommendationCache:
+    """进程内L1推荐缓存（LRU + TTL）
+
+    位于RecommendationCache之前，按 (user_id, page_type) 缓存构建好的
+    RecommendationItem列表。失效消息通过Redis pub/sub广播到所有worker。
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()  # (user_id, page_type) -> (过期时间, 推荐列表)
+        self._user_keys: Dict[str, set] = {}
+
+    def get(self, user_id: str, page_type: str) -> Optional[List[RecommendationItem]]:
+        """获取缓存的推荐结果，过期则删除"""
+        key = (user_id, page_type)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, recommendations = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return list(recommendations)
+
+    def put(self, user_id: str, page_type: str, recommendations: List[RecommendationItem]):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        key = (user_id, page_type)
+        self._entries[key] = (time.monotonic() + self.ttl, list(recommendations))
+        self._entries.move_to_end(key)
+        self._user_keys.setdefault(user_id, set()).add(key)
+
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def invalidate_user(self, user_id: str):
+        """失效某个用户的全部页面缓存"""
+        for key in self._user_keys.pop(user_id, ()):
+            self._entries.pop(key, None)
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        user_keys = self._user_keys.get(key[0])
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._user_keys[key[0]]
+
+    async def listen_invalidations(self, redis_client: Redis):
+        """订阅失效广播（在lifespan中作为后台任务运行）"""
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self.invalidate_user(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 订阅断开时清空本地缓存，避免错过失效消息后返回旧结果
+                logger.error(f"Cache invalidation listener error: {e}")
+                self._entries.clear()
+                self._user_keys.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
+
+# 在线推理使用的特征（FeatureView:特征名）
+USER_FEATURE_REFS = [
+    "user_profile_features:total_clicks",
+    "user_profile_features:total_purchases",
+    "user_profile_features:avg_dwell_time",
+    "user_profile_features:user_segment",
+    "user_realtime_features:click_count_5min",
+    "user_realtime_features:recent_items",
+    "user_statistical_features:click_7d_avg",
+    "user_statistical_features:purchase_30d_total"
+]
+
+ITEM_FEATURE_REFS = [
+    "item_statistical_features:total_clicks",
+    "item_statistical_features:total_purchases",
+    "item_statistical_features:purchase_rate",
+    "item_statistical_features:popularity_score",
+]
+
+ITEM_FEATURE_NAMES = [ref.split(":", 1)[1] for ref in ITEM_FEATURE_REFS]
+
+class CategorySimilarityTable:
+    """品类相似度查找表
+
+    品类在获取物品特征时被映射为小整数编码，任意两个品类的相似度从预先计算的
+    编码×编码矩阵中直接查表。遇到新品类时追加编码（已有编码保持不变），
+    并在下次查表前重建矩阵。大类由品类名前缀决定，没有单独的品类目录需要
+    加载，目录中新增的品类在第一次出现时即进入查找表。
+    """
+
+    def __init__(self, same_category: float = 0.8, same_group: float = 0.5,
+                 other: float = 0.1, group_prefix_len: int = 3):
+        self.same_category = same_category
+        self.same_group = same_group
+        self.other = other
+        self.group_prefix_len = group_prefix_len
+        self._codes: Dict[Any, int] = {}
+        self._groups: Dict[str, int] = {}
+        self._group_of_code: List[int] = []
+        self._matrix = np.empty((0, 0), dtype=np.float64)
+
+    def encode(self, category) -> int:
+        """获取品类编码，新品类追加到表中"""
+        code = self._codes.get(category)
+        if code is None:
+            code = len(self._codes)
+            self._codes[category] = code
+            if category:
+                prefix = category[:self.group_prefix_len]
+                self._group_of_code.append(self._groups.setdefault(prefix, len(self._groups)))
+            else:
+                self._group_of_code.append(-1)  # 空品类不属于任何大类
+        return code
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """编码×编码相似度矩阵"""
+        if self._matrix.shape[0] != len(self._codes):
+            self._build()
+        return self._matrix
+
+    def similarity(self, category1, category2) -> float:
+        code1, code2 = self.encode(category1), self.encode(category2)
+        return float(self.matrix[code1, code2])
+
+    def _build(self):
+        groups = np.array(self._group_of_code, dtype=np.int64)
+        same_group = (groups[:, None] == groups[None, :]) & (groups[:, None] >= 0)
+        matrix = np.where(same_group, self.same_group, self.other)
+        np.fill_diagonal(matrix, self.same_category)
+        self._matrix = matrix
+
 class FeatureService:
     """特征服务"""
 
-    def __init__(self, feature_store_path: str, redis_client: Redis):
+    def __init__(self, feature_store_path: str, redis_client: Redis,
+                 max_concurrency: int = 8, max_queue: int = 256,
+                 category_table: Optional[CategorySimilarityTable] = None):
         self.fs = FeatureStore(repo_path=feature_store_path)
         self.redis = redis_client
+        self.category_table = category_table or CategorySimilarityTable()
+        self.item_snapshot: Optional[ItemFeatureSnapshot] = None
+
+        # Feast的get_online_features是同步调用，放到有界线程池执行，避免阻塞事件循环
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="feature-store"
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+
+    async def _get_online_features(self, features: List[str], entity_rows: List[Dict]) -> Dict:
+        """在线程池中读取在线特征，并发数受限，排队过长时直接失败走降级"""
+        if self._waiting >= self.max_queue:
+            feature_store_rejected_counter.inc()
+            raise RuntimeError("Feature store queue is full")
+
+        self._waiting += 1
+        feature_store_queue_depth.set(self._waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+            feature_store_queue_depth.set(self._waiting)
+
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self._executor,
+                functools.partial(self._read_online_features, features, entity_rows)
+            )
+        except Exception:
+            self._semaphore.release()
+            raise
+        # 线程中的读取无法取消：调用方超时放弃后，读取完成时才释放并发名额
+        future.add_done_callback(lambda _: self._semaphore.release())
+        return await asyncio.shield(future)
+
+    def _read_online_features(self, features: List[str], entity_rows: List[Dict]) -> Dict:
+        return self.fs.get_online_features(
+            features=features,
+            entity_rows=entity_rows
+        ).to_dict()
+
+    def close(self):
+        """关闭特征读取线程池"""
+        self._executor.shutdown(wait=False)
 
     async def get_user_features(self, user_id: str) -> Dict:
         """获取用户特征"""
         try:
             # 从FeatureStore获取在线特征
-            features = self.fs.get_online_features(
-                features=[
-                    "user_profile_features:total_clicks",
-                    "user_profile_features:total_purchases",
-                    "user_profile_features:avg_dwell_time",
-                    "user_profile_features:user_segment",
-                    "user_realtime_features:click_count_5min",
-                    "user_realtime_features:recent_items",
-                    "user_statistical_features:click_7d_avg",
-                    "user_statistical_features:purchase_30d_total"
-                ],
-                entity_rows=[{"user_id": user_id}]
-            ).to_dict()
+            features = await self._get_online_features(
+                USER_FEATURE_REFS,
+                [{"user_id": user_id}]
+            )
 
             return {k: v[0] if v else None for k, v in features.items()}
         except Exception as e:
@@ -206,121 +853,552 @@ class FeatureService:
             "total_clicks": 0
         }
 
+    def load_item_snapshot(self, root: str) -> bool:
+        """打开root/current指向的快照，与已加载的相同则跳过；整体替换，不影响进行中的读取"""
+        path = current_snapshot_path(root)
+        if path is None or (self.item_snapshot is not None and self.item_snapshot.path == path):
+            return False
+        self.item_snapshot = ItemFeatureSnapshot(path, columns=ITEM_FEATURE_NAMES)
+        item_snapshot_size.set(len(self.item_snapshot))
+        logger.info(f"Loaded item feature snapshot {path} with {len(self.item_snapshot)} items")
+        return True
+
+    async def watch_item_snapshot(self, root: str, interval: float):
+        """定期检查是否有新快照"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.load_item_snapshot, root)
+            except Exception as e:
+                logger.error(f"Error loading item feature snapshot: {e}")
+
+    def get_snapshot_item_features(self, item_ids: List[str]) -> Tuple[Dict[str, Dict], List[str]]:
+        """从本地快照读取物品特征，返回 (命中的特征, 未命中的物品ID)"""
+        snapshot = self.item_snapshot
+        if snapshot is None:
+            return {}, list(item_ids)
+
+        result, missing = snapshot.get_many(item_ids)
+        for item_feat in result.values():
+            item_feat['category_code'] = self.category_table.encode(item_feat.get('category', ''))
+        item_snapshot_lookup_counter.labels(result='hit').inc(len(result))
+        item_snapshot_lookup_counter.labels(result='miss').inc(len(missing))
+        return result, missing
+
     async def get_item_features(self, item_ids: List[str]) -> Dict[str, Dict]:
-        """批量获取物品特征"""
+        """批量获取物品特征：先查本地快照，未命中的再读Feast"""
+        result, missing = self.get_snapshot_item_features(item_ids)
+        if missing:
+            result.update(await self.get_online_item_features(missing))
+        return result
+
+    async def get_online_item_features(self, item_ids: List[str]) -> Dict[str, Dict]:
+        """从Feast批量获取物品特征"""
         try:
             entity_rows = [{"item_id": item_id} for item_id in item_ids]
-            features = self.fs.get_online_features(
-                features=[
-                    "item_statistical_features:total_clicks",
-                    "item_statistical_features:total_purchases",
-                    "item_statistical_features:purchase_rate",
-                    "item_statistical_features:popularity_score",
-                ],
-                entity_rows=entity_rows
-            ).to_dict()
-
-            # 转换为每个物品的特征字典
+            features = await self._get_online_features(ITEM_FEATURE_REFS, entity_rows)
+
+            # 转换为每个物品的特征字典，并附上品类编码
             result = {}
             for i, item_id in enumerate(item_ids):
-                result[item_id] = {
+                item_feat = {
                     k: v[i] if v else None
                     for k, v in features.items()
                 }
+                item_feat['category_code'] = self.category_table.encode(item_feat.get('category', ''))
+                result[item_id] = item_feat
             return result
         except Exception as e:
             logger.error(f"Error getting item features: {e}")
             return {item_id: {} for item_id in item_ids}
 
+class FeatureAssembler:
+    """特征矩阵组装器
+
+    模型加载时根据feature_names预先计算列索引：物品特征列逐物品写入，
+    其余列取用户特征，每个请求只计算一次后广播到所有行。
+    物品特征覆盖同名用户特征，缺失值记为0。
+    """
+
+    def __init__(self, feature_names: List[str], item_feature_names: List[str]):
+        self.feature_names = list(feature_names)
+        self.n_features = len(self.feature_names)
+        item_names = set(item_feature_names)
+        self.item_columns = [
+            (j, name) for j, name in enumerate(self.feature_names) if name in item_names
+        ]
+
+    def build_user_row(self, user_features: Dict) -> np.ndarray:
+        """构建用户特征行（物品特征列以同名用户特征作为默认值）"""
+        row = np.zeros(self.n_features, dtype=np.float32)
+        for j, name in enumerate(self.feature_names):
+            value = user_features.get(name)
+            if value is not None:
+                row[j] = float(value)
+        return row
+
+    def assemble(self, user_features: Dict, item_features: Dict[str, Dict],
+                 item_ids: List[str], out: Optional[np.ndarray] = None) -> np.ndarray:
+        """组装 (候选数 × 特征数) 的float32特征矩阵，可直接写入调用方预分配的out"""
+        user_row = self.build_user_row(user_features)
+        if out is None:
+            out = np.empty((len(item_ids), self.n_features), dtype=np.float32)
+        matrix = out
+        matrix[:] = user_row
+
+        item_rows = [item_features[item_id] for item_id in item_ids]
+        for j, name in self.item_columns:
+            default = user_row[j]
+            column = [row.get(name, default) for row in item_rows]
+            matrix[:, j] = [0.0 if value is None else value for value in column]
+
+        return matrix
+
+class LightFMScorer:
+    """LightFM打分引擎
+
+    加载时把训练保存的模型和ID映射展开成连续的float32嵌入矩阵与偏置，
+    每次请求只做一次 (候选数 × 维度) 与用户向量的矩阵-向量乘积。
+    矩阵最后一行是均值向量，未知用户或物品按"平均用户/平均物品"打分。
+    """
+
+    def __init__(self, user_index: Dict[str, int], item_index: Dict[str, int],
+                 user_embeddings: np.ndarray, user_biases: np.ndarray,
+                 item_embeddings: np.ndarray, item_biases: np.ndarray):
+        self.user_index = user_index
+        self.item_index = item_index
+        self.unknown_user = len(user_index)
+        self.unknown_item = len(item_index)
+        self.user_embeddings = self._with_mean_row(user_embeddings)
+        self.user_biases = self._with_mean_row(user_biases)
+        self.item_embeddings = self._with_mean_row(item_embeddings)
+        self.item_biases = self._with_mean_row(item_biases)
+
+    @staticmethod
+    def _with_mean_row(values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=np.float32)
+        return np.ascontiguousarray(np.concatenate([values, values.mean(axis=0, keepdims=True)]))
+
+    @classmethod
+    def from_saved(cls, saved: Dict) -> 'LightFMScorer':
+        """从train_lightfm保存的 {'model', 'dataset', 'user_mapping', 'item_mapping'} 构建"""
+        model = saved['model']
+        user_biases, user_embeddings = model.get_user_representations()
+        item_biases, item_embeddings = model.get_item_representations()
+        return cls(
+            user_index={str(k): int(v) for k, v in saved['user_mapping'].items()},
+            item_index={str(k): int(v) for k, v in saved['item_mapping'].items()},
+            user_embeddings=user_embeddings,
+            user_biases=user_biases,
+            item_embeddings=item_embeddings,
+            item_biases=item_biases
+        )
+
+    def score(self, user_id: Optional[str], item_ids: List[str]) -> np.ndarray:
+        """返回每个候选的得分（经sigmoid映射到0~1，与排序模型的概率同量纲）"""
+        user = self.user_index.get(str(user_id), self.unknown_user) if user_id is not None else self.unknown_user
+        rows = np.fromiter(
+            (self.item_index.get(item_id, self.unknown_item) for item_id in item_ids),
+            dtype=np.int64, count=len(item_ids)
+        )
+        raw = self.item_embeddings[rows] @ self.user_embeddings[user]
+        raw += self.item_biases[rows]
+        raw += self.user_biases[user]
+        return 1.0 / (1.0 + np.exp(-raw))
+
+class LoadedModel:
+    """一个已加载的模型版本，加载后不再修改，通过整体替换实现原子切换"""
+
+    def __init__(self, version: str, model: Any, feature_names: Optional[List[str]]):
+        self.version = version
+        self.model = model
+        self.feature_names = feature_names
+        self.assembler = (
+            FeatureAssembler(feature_names, ITEM_FEATURE_NAMES) if feature_names else None
+        )
+
 class ModelService:
-    """模型服务"""
+    """模型服务
+
+    model_version为latest时可在后台监听模型目录，新版本在旧模型继续服务的同时
+    加载并预热，完成后原子切换；保留上一个版本以便回滚。
+    只加载带有完成标记（MODEL_COMPLETE_MARKER）的版本目录，加载失败的版本按指数退避重试。
+    """
 
-    def __init__(self, model_path: str, model_name: str, model_version: str):
+    reload_backoff_base = 5.0  # 加载失败后的首次重试间隔（秒）
+    reload_backoff_max = 600.0  # 重试间隔上限（秒）
+
+    def __init__(self, model_path: str, model_name: str, model_version: str,
+                 max_batch_size: int = 256, scorer: str = 'auto',
+                 rolled_back_versions: Optional[set] = None,
+                 max_concurrency: int = 4, max_queue: int = 64):
         self.model_path = model_path
         self.model_name = model_name
-        self.model_version = model_version
-        self.model = None
-        self.feature_names = None
+        self.requested_version = model_version
+        self.max_batch_size = max(1, max_batch_size)
+        self.scorer = scorer
+        self.active: Optional[LoadedModel] = None
+        self.previous: Optional[LoadedModel] = None
+        self._skipped_versions: set = set(rolled_back_versions or ())  # 已回滚的版本，不再自动加载
+        self._failed_versions: Dict[str, Tuple[int, float]] = {}  # 加载失败的版本 -> (失败次数, 下次重试时间)
+        self._recent_matrices = deque(maxlen=4)  # 最近的线上特征矩阵，用于预热新模型
+
+        # 在线打分使用独立的有界线程池：超出预算被放弃的打分仍会跑完，
+        # 不能让它们在共享的默认线程池中排在其他请求前面
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_concurrency),
+            thread_name_prefix="model-scoring"
+        )
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self._waiting = 0
         self.load_model()
 
+    @property
+    def model(self):
+        return self.active.model if self.active else None
+
+    @property
+    def feature_names(self) -> Optional[List[str]]:
+        return self.active.feature_names if self.active else None
+
+    @property
+    def assembler(self) -> Optional[FeatureAssembler]:
+        return self.active.assembler if self.active else None
+
+    @property
+    def model_version(self) -> str:
+        return self.active.version if self.active else self.requested_version
+
     def load_model(self):
-        """加载模型"""
+        """加载模型（启动时同步调用）"""
         try:
-            if self.model_version == 'latest':
-                # 查找最新版本
-                import glob
-                versions = glob.glob(f"{self.model_path}/{self.model_name}/*")
-                if versions:
-                    self.model_version = max([v.split('/')[-1] for v in versions])
-
-            model_file = f"{self.model_path}/{self.model_name}/{self.model_version}/model.pkl"
-
-            if self.model_name == 'xgboost':
-                self.model = joblib.load(model_file)
-            elif self.model_name == 'lightfm':
-                with open(model_file, 'rb') as f:
-                    self.model = pickle.load(f)
-            else:
-                raise ValueError(f"Unknown model type: {self.model_name}")
+            version = self.requested_version
+            if version == 'latest':
+                # 查找最新版本；没有带完成标记的版本时兼容旧的模型目录
+                version = self._resolve_latest_version()
+                if version is None:
+                    version = self._resolve_latest_version(require_marker=False)
+                    if version is not None:
+                        logger.warning(f"Model {self.model_name}:{version} has no "
+                                       f"{MODEL_COMPLETE_MARKER} marker, loading it anyway at startup")
+                if version is None:
+                    raise ValueError(f"No model found for {self.model_name}")
+
+            loaded = self._load_version(version)
+            self._warm_up(loaded)
+            self._activate(loaded)
+        except Exception as e:
+            logger.error(f"Error loading model: {e}")
 
-            # 加载特征名称
-            feature_file = f"{self.model_path}/{self.model_name}/{self.model_version}/feature_names.json"
-            if os.path.exists(feature_file):
-                with open(feature_file, 'r') as f:
-                    self.feature_names = json.load(f)
+    def _resolve_latest_version(self, require_marker: bool = True) -> Optional[str]:
+        """最新的已写完的版本（目录中有完成标记），跳过已回滚的版本"""
+        import glob
+        marker = MODEL_COMPLETE_MARKER if require_marker else "model.pkl"
+        versions = [
+            v.split('/')[-2] for v in glob.glob(f"{self.model_path}/{self.model_name}/*/{marker}")
+        ]
+        versions = [v for v in versions if v not in self._skipped_versions]
+        if not versions:
+            return None
+        return max(versions)
+
+    def _load_version(self, version: str) -> LoadedModel:
+        """从磁盘加载指定版本"""
+        start = time.perf_counter()
+        version_dir = f"{self.model_path}/{self.model_name}/{version}"
+        model_file = f"{version_dir}/model.pkl"
+
+        if self.model_name == 'xgboost':
+            model = self._load_xgboost(version_dir)
+        elif self.model_name == 'lightfm':
+            with open(model_file, 'rb') as f:
+                model = LightFMScorer.from_saved(pickle.load(f))
+        else:
+            raise ValueError(f"Unknown model type: {self.model_name}")
+
+        # 加载特征名称
+        feature_names = None
+        feature_file = f"{version_dir}/feature_names.json"
+        if os.path.exists(feature_file):
+            with open(feature_file, 'r') as f:
+                feature_names = json.load(f)
+        if self.model_name == 'xgboost' and not feature_names:
+            # 没有特征名无法组装特征矩阵，激活后所有请求都会得到空结果
+            raise ValueError(f"Model {self.model_name}:{version} has no feature_names.json")
+
+        model_load_seconds.observe(time.perf_counter() - start)
+        logger.info(f"Loaded model {self.model_name}:{version}")
+        return LoadedModel(version, model, feature_names)
+
+    def _load_xgboost(self, version_dir: str):
+        """加载XGBoost模型，按scorer配置返回原生模型或编译后的CompiledTreeEnsemble"""
+        compiled_file = f"{version_dir}/tree_ensemble.npz"
+        if self.scorer == 'compiled' and os.path.exists(compiled_file):
+            # 离线编译好的版本，不需要xgboost
+            return CompiledTreeEnsemble.load(compiled_file)
+
+        model = joblib.load(f"{version_dir}/model.pkl")
+        if self.scorer == 'native':
+            return model
 
-            logger.info(f"Loaded model {self.model_name}:{self.model_version}")
+        try:
+            compiled = CompiledTreeEnsemble.from_xgboost(model)
+            X = parity_matrix(self.max_batch_size, compiled.n_features)
+            check_parity(compiled, model, X)
         except Exception as e:
-            logger.error(f"Error loading model: {e}")
-            self.model = None
+            logger.warning(f"Using native XGBoost scorer, compile failed: {e}")
+            return model
+
+        if self.scorer == 'auto':
+            native_ms = benchmark_ms(model.predict_proba, X)
+            compiled_ms = benchmark_ms(compiled.predict_proba, X)
+            logger.info(f"Scorer benchmark: native={native_ms:.3f}ms compiled={compiled_ms:.3f}ms")
+            if native_ms <= compiled_ms:
+                return model
+        return compiled
+
+    def _warm_up(self, loaded: LoadedModel):
+        """用最近的线上特征矩阵（没有时用随机矩阵）预热模型"""
+        if loaded.assembler is None:
+            return
+
+        start = time.perf_counter()
+        n_features = loaded.assembler.n_features
+        matrices = [m for m in list(self._recent_matrices) if m.shape[1] == n_features]
+        if not matrices:
+            rng = np.random.default_rng(0)
+            matrices = [rng.random((self.max_batch_size, n_features), dtype=np.float32)]
+        for matrix in matrices:
+            self._score_matrix(matrix, loaded.model)
+        model_warmup_seconds.observe(time.perf_counter() - start)
+
+    def _activate(self, loaded: LoadedModel):
+        if self.active is not None:
+            self.previous = self.active
+        # 已回滚的版本不保留为上一个版本，避免再次回滚时切回它
+        if self.previous is not None and self.previous.version in self._skipped_versions:
+            self.previous = None
+        self.active = loaded
+        self._export_active_version()
+
+    def _export_active_version(self):
+        model_active_version.clear()
+        model_active_version.labels(model_name=self.model_name, version=self.active.version).set(1)
+
+    async def reload(self, version: str) -> bool:
+        """在线程池中加载并预热指定版本，成功后原子切换，旧模型在此期间继续服务"""
+        loop = asyncio.get_running_loop()
+        try:
+            loaded = await loop.run_in_executor(None, self._load_version, version)
+            await loop.run_in_executor(None, self._warm_up, loaded)
+        except Exception as e:
+            failures = self._failed_versions.get(version, (0, 0.0))[0] + 1
+            delay = min(self.reload_backoff_base * 2 ** (failures - 1), self.reload_backoff_max)
+            self._failed_versions[version] = (failures, time.monotonic() + delay)
+            logger.error(f"Error reloading model {self.model_name}:{version} "
+                         f"(attempt {failures}, retry in {delay:.0f}s): {e}")
+            return False
+
+        self._failed_versions.pop(version, None)
+        self._activate(loaded)
+        logger.info(f"Switched to model {self.model_name}:{version}")
+        return True
+
+    async def rollback_version(self, version: str) -> bool:
+        """回滚指定版本：标记为不再加载，当前正在使用它时切换到上一个版本
+
+        内存中没有可用的上一个版本时，从磁盘加载除已回滚版本外最新的版本。
+        返回当前worker是否发生了切换。
+        """
+        if self.active is None or self.active.version != version:
+            self._skipped_versions.add(version)
+            return False
+
+        if self.previous is not None and self.previous.version != version:
+            self._skipped_versions.add(version)
+            self.active, self.previous = self.previous, None
+            self._export_active_version()
+            logger.info(f"Rolled back to model {self.model_name}:{self.active.version}")
+            return True
+
+        loop = asyncio.get_running_loop()
+        self._skipped_versions.add(version)
+        target = await loop.run_in_executor(None, self._resolve_latest_version)
+        if target is None or not await self.reload(target):
+            # 没有可切换的版本，继续使用当前版本
+            self._skipped_versions.discard(version)
+            return False
+        logger.info(f"Rolled back to model {self.model_name}:{target}")
+        return True
+
+    async def listen_rollbacks(self, redis_client: Redis):
+        """订阅回滚广播，使所有worker一起回滚（在lifespan中作为后台任务运行）
+
+        每次订阅成功后先补齐Redis中记录的已回滚版本，启动时Redis不可用或断线期间
+        错过的回滚也会生效。
+        """
+        rolled_back_key = MODEL_ROLLED_BACK_KEY.format(model_name=self.model_name)
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(MODEL_ROLLBACK_CHANNEL)
+                for version in await redis_client.smembers(rolled_back_key):
+                    if version not in self._skipped_versions:
+                        await self.rollback_version(version)
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        await self.rollback_version(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Model rollback listener error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
+
+    async def watch(self, interval: float):
+        """定期检查模型目录，发现新版本时热加载；加载失败的版本到重试时间后再试"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                version = await loop.run_in_executor(None, self._resolve_latest_version)
+                if version is None or (self.active is not None and version == self.active.version):
+                    continue
+                failed = self._failed_versions.get(version)
+                if failed is not None and time.monotonic() < failed[1]:
+                    continue
+                await self.reload(version)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Model watcher error: {e}")
+
+    async def run_scoring(self, fn, *args, **kwargs):
+        """在打分线程池中执行fn，并发数受限，排队过长时直接失败由调用方降级"""
+        if self._waiting >= self.max_queue:
+            model_scoring_rejected_counter.inc()
+            raise RuntimeError("Model scoring queue is full")
+
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
 
-    async def predict(self, user_features: Dict, item_features: Dict[str, Dict]) -> Dict[str, float]:
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        except Exception:
+            self._semaphore.release()
+            raise
+        # 线程中的打分无法取消：调用方超时放弃后，打分完成时才释放并发名额
+        future.add_done_callback(lambda _: self._semaphore.release())
+        return await asyncio.shield(future)
+
+    def close(self):
+        """关闭打分线程池"""
+        self._executor.shutdown(wait=False)
+
+    async def predict(self, user_features: Dict, item_features: Dict[str, Dict],
+                      user_id: Optional[str] = None) -> Dict[str, float]:
         """预测用户对每个物品的得分"""
-        if self.model is None:
-            return self._fallback_predict(item_features)
+        return self.score(user_features, item_features, user_id=user_id)
+
+    def score(self, user_features: Dict, item_features: Dict[str, Dict],
+              user_id: Optional[str] = None) -> Dict[str, float]:
+        """同步打分，可放到线程池中执行以便调用方设置超时"""
+        active = self.active  # 本次预测固定使用同一个模型版本
+        if active is None:
+            return self.fallback_predict(item_features)
 
-        scores = {}
         try:
-            # 构建特征向量
-            for item_id, item_feat in item_features.items():
-                # 合并用户和物品特征
-                features = {}
-                features.update(user_features)
-                features.update(item_feat)
-
-                # 转换为特征向量
-                feature_vector = self._build_feature_vector(features)
-
-                if feature_vector is not None:
-                    # 预测
-                    if hasattr(self.model, 'predict_proba'):
-                        proba = self.model.predict_proba([feature_vector])[0]
-                        scores[item_id] = float(proba[1])  # 正类概率
-                    else:
-                        score = self.model.predict([feature_vector])[0]
-                        scores[item_id] = float(score)
-
-            return scores
+            item_ids = list(item_features.keys())
+            if isinstance(active.model, LightFMScorer):
+                with stage_timer('model_scoring'):
+                    scores = active.model.score(user_id or user_features.get('user_id'), item_ids)
+                return {item_id: float(score) for item_id, score in zip(item_ids, scores)}
+
+            # 构建 (候选数 × 特征数) 特征矩阵
+            if active.assembler is None or not item_ids:
+                return {}
+            with stage_timer('feature_assembly'):
+                matrix = active.assembler.assemble(user_features, item_features, item_ids)
+            self._recent_matrices.append(matrix)
+
+            # 批量预测
+            with stage_timer('model_scoring'):
+                raw_scores = self._score_matrix(matrix, active.model)
+            return {item_id: float(score) for item_id, score in zip(item_ids, raw_scores)}
         except Exception as e:
             logger.error(f"Prediction error: {e}")
-            return self._fallback_predict(item_features)
-
-    def _build_feature_vector(self, features: Dict) -> np.ndarray:
-        """构建特征向量"""
-        if not self.feature_names:
-            return None
+            return self.fallback_predict(item_features)
+
+    def score_batch(self, user_features_list: List[Dict],
+                    item_features_list: List[Dict[str, Dict]],
+                    user_ids: Optional[List[str]] = None) -> List[Dict[str, float]]:
+        """同步批量打分，所有用户-物品对堆叠成一个矩阵一次打分；通过run_scoring在打分线程池中执行"""
+        active = self.active
+        if active is None:
+            return [self.fallback_predict(item_features) for item_features in item_features_list]
+        if isinstance(active.model, LightFMScorer):
+            # 嵌入打分每个用户只是一次矩阵-向量乘积，逐用户计算即可
+            user_ids = user_ids or [None] * len(user_features_list)
+            return [
+                self.score(user_features, item_features, user_id=user_id)
+                for user_features, item_features, user_id in zip(
+                    user_features_list, item_features_list, user_ids)
+            ]
+        if active.assembler is None:
+            return [{} for _ in item_features_list]
 
-        vector = []
-        for name in self.feature_names:
-            value = features.get(name, 0)
-            # 处理缺失值
-            if value is None:
-                value = 0
-            vector.append(float(value))
-
-        return np.array(vector).reshape(1, -1)
+        try:
+            item_id_lists = [list(item_features.keys()) for item_features in item_features_list]
+            total = sum(len(item_ids) for item_ids in item_id_lists)
+            if total == 0:
+                return [{} for _ in item_features_list]
+
+            with stage_timer('feature_assembly'):
+                matrix = np.empty((total, active.assembler.n_features), dtype=np.float32)
+                offset = 0
+                for user_features, item_features, item_ids in zip(
+                        user_features_list, item_features_list, item_id_lists):
+                    end = offset + len(item_ids)
+                    if item_ids:
+                        active.assembler.assemble(user_features, item_features, item_ids, out=matrix[offset:end])
+                    offset = end
+
+            with stage_timer('model_scoring'):
+                raw_scores = self._score_matrix(matrix, active.model)
+
+            results = []
+            offset = 0
+            for item_ids in item_id_lists:
+                end = offset + len(item_ids)
+                results.append({
+                    item_id: float(score)
+                    for item_id, score in zip(item_ids, raw_scores[offset:end])
+                })
+                offset = end
+            return results
+        except Exception as e:
+            logger.error(f"Batch prediction error: {e}")
+            return [self.fallback_predict(item_features) for item_features in item_features_list]
+
+    def _score_matrix(self, matrix: np.ndarray, model) -> np.ndarray:
+        """按max_batch_size分块调用模型，返回每行得分"""
+        chunks = []
+        for start in range(0, matrix.shape[0], self.max_batch_size):
+            batch = matrix[start:start + self.max_batch_size]
+            if hasattr(model, 'predict_proba'):
+                chunks.append(model.predict_proba(batch)[:, 1])  # 正类概率
+            else:
+                chunks.append(np.asarray(model.predict(batch)).reshape(-1))
+        return np.concatenate(chunks)
 
-    def _fallback_predict(self, item_features: Dict[str, Dict]) -> Dict[str, float]:
+    def fallback_predict(self, item_features: Dict[str, Dict]) -> Dict[str, float]:
         """降级预测（基于流行度）"""
         scores = {}
         for item_id, features in item_features.items():
@@ -329,66 +1407,545 @@ class ModelService:
             scores[item_id] = float(popularity)
         return scores
 
+# ============ 向量召回 ============
+
+class ItemEmbeddingIndex:
+    """物品向量召回索引
+
+    从Redis的 item:{item_id}:embedding 读取物品向量的原始值，解析、堆叠和IVF
+    索引构建都在线程池中完成，之后整体替换，重建期间旧索引继续服务。
+    查询在进程内完成，不访问Redis。
+    """
+
+    def __init__(self, redis_client: Redis, n_lists: int = 0, nprobe: int = 8,
+                 scan_batch_size: int = 1000):
+        self.redis = redis_client
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.scan_batch_size = scan_batch_size
+        # (索引, 物品ID列表, 物品ID -> 下标)，作为一个整体原子替换
+        self._snapshot: Optional[Tuple[IVFIndex, List[str], Dict[str, int]]] = None
+
+    def __len__(self) -> int:
+        return len(self._snapshot[1]) if self._snapshot else 0
+
+    async def load_embeddings(self) -> Tuple[List[str], List[str]]:
+        """扫描并批量读取所有物品向量，返回 (键, 未解析的JSON值)，不在事件循环中解析"""
+        all_keys: List[str] = []
+        all_values: List[str] = []
+        keys: List[str] = []
+
+        async def flush():
+            values = await self.redis.mget(keys)
+            all_keys.extend(keys)
+            all_values.extend(values)
+            keys.clear()
+
+        async for key in self.redis.scan_iter(match="item:*:embedding", count=self.scan_batch_size):
+            keys.append(key)
+            if len(keys) >= self.scan_batch_size:
+                await flush()
+        if keys:
+            await flush()
+
+        return all_keys, all_values
+
+    def _build_snapshot(self, keys: List[str], values: List[str]
+                        ) -> Optional[Tuple[IVFIndex, List[str], Dict[str, int]]]:
+        """解析向量、构建索引和物品ID映射（CPU密集，在线程池中执行）"""
+        item_ids: List[str] = []
+        vectors: List[List[float]] = []
+        for key, value in zip(keys, values):
+            if not value:
+                continue
+            vector = json.loads(value)
+            if vectors and len(vector) != len(vectors[0]):
+                continue
+            item_ids.append(key[len("item:"):-len(":embedding")])
+            vectors.append(vector)
+        if not item_ids:
+            return None
+
+        index = IVFIndex(np.asarray(vectors, dtype=np.float32), n_lists=self.n_lists)
+        return index, item_ids, {item_id: i for i, item_id in enumerate(item_ids)}
+
+    async def rebuild(self) -> int:
+        """重新加载向量并构建索引，返回索引中的物品数"""
+        start = time.perf_counter()
+        keys, values = await self.load_embeddings()
+
+        loop = asyncio.get_running_loop()
+        snapshot = await loop.run_in_executor(
+            None, functools.partial(self._build_snapshot, keys, values)
+        )
+        if snapshot is None:
+            logger.warning("No item embeddings found, embedding recall disabled")
+            return len(self)
+
+        self._snapshot = snapshot
+        index, item_ids, _ = snapshot
+        embedding_index_size.set(len(item_ids))
+        embedding_index_build_seconds.observe(time.perf_counter() - start)
+        logger.info(f"Built embedding index with {len(item_ids)} items, {index.n_lists} lists")
+        return len(item_ids)
+
+    async def run(self, interval: float):
+        """启动时构建一次，之后按间隔后台重建"""
+        while True:
+            try:
+                await self.rebuild()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Embedding index rebuild error: {e}")
+            if interval <= 0:
+                return
+            await asyncio.sleep(interval)
+
+    def user_vector(self, item_ids: List[str]) -> Optional[np.ndarray]:
+        """用最近交互物品向量的均值作为用户向量"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        index, _, positions = snapshot
+        rows = [positions[item_id] for item_id in item_ids if item_id in positions]
+        if not rows:
+            return None
+        return index.get_vectors(rows).mean(axis=0)
+
+    def search(self, query: np.ndarray, k: int) -> List[str]:
+        """返回与查询向量最相近的k个物品ID"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+        index, item_ids, _ = snapshot
+        if query.shape[-1] != index.dim:
+            return []
+        rows, _ = index.search(query, k, self.nprobe)
+        return [item_ids[row] for row in rows]
+
 # ============ 推荐引擎 ============
 
+class RequestContext:
+    """请求级上下文
+
+    在召回、排序、后处理各阶段之间传递，同一请求内的用户特征、物品特征和
+    Redis读取只访问后端一次，并发阶段共享同一次读取。
+    """
+
+    def __init__(self, feature_service, redis_client: Redis):
+        self.feature_service = feature_service
+        self.redis = redis_client
+        self.backend_reads = {'feature_store': 0, 'redis': 0}
+        self._memo: Dict[tuple, asyncio.Future] = {}
+        self._item_features: Dict[str, Dict] = {}
+
+    async def _memoized(self, key: tuple, backend: str, factory):
+        future = self._memo.get(key)
+        if future is None:
+            self.backend_reads[backend] += 1
+            future = asyncio.ensure_future(factory())
+            self._memo[key] = future
+        # shield: 某一路召回超时被取消时，不影响共享同一次读取的其他阶段
+        return await asyncio.shield(future)
+
+    async def get_user_features(self, user_id: str) -> Dict:
+        """获取用户特征（请求内只读取一次）"""
+        return await self._memoized(
+            ('user_features', user_id), 'feature_store',
+            lambda: self.feature_service.get_user_features(user_id)
+        )
+
+    async def get_item_features(self, item_ids: List[str]) -> Dict[str, Dict]:
+        """批量获取物品特征，只读取本请求尚未获取过的物品"""
+        missing = [item_id for item_id in dict.fromkeys(item_ids)
+                   if item_id not in self._item_features]
+        if missing:
+            # 本地快照命中的不计为后端读取
+            fetched, online_missing = self.feature_service.get_snapshot_item_features(missing)
+            if online_missing:
+                self.backend_reads['feature_store'] += 1
+                fetched.update(await self.feature_service.get_online_item_features(online_missing))
+            for item_id in missing:
+                self._item_features.setdefault(item_id, fetched.get(item_id, {}))
+        return {item_id: self._item_features[item_id] for item_id in item_ids}
+
+    async def lrange(self, key: str, start: int, end: int) -> List[str]:
+        return await self._memoized(
+            ('lrange', key, start, end), 'redis',
+            lambda: self.redis.lrange(key, start, end)
+        )
+
+    async def zrevrange_many(self, keys: List[str], end: int) -> List[str]:
+        """通过一个pipeline批量读取多个有序集合，按keys顺序拼接结果"""
+        missing = [key for key in dict.fromkeys(keys)
+                   if ('zrevrange', key, end) not in self._memo]
+        if missing:
+            loop = asyncio.get_running_loop()
+            futures = [loop.create_future() for _ in missing]
+            for key, future in zip(missing, futures):
+                self._memo[('zrevrange', key, end)] = future
+
+            self.backend_reads['redis'] += 1
+            pipe = self.redis.pipeline(transaction=False)
+            for key in missing:
+                pipe.zrevrange(key, 0, end)
+            try:
+                results = await pipe.execute()
+            except Exception as e:
+                for key, future in zip(missing, futures):
+                    self._memo.pop(('zrevrange', key, end), None)
+                    future.set_exception(e)
+                    future.exception()  # 标记已读取，由本调用抛出
+                raise
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+        items = []
+        for key in keys:
+            items.extend(await self._memo[('zrevrange', key, end)])
+        return items
+
+class LatencyBudget:
+    """请求级延迟预算
+
+    按各阶段占比计算累计截止时间：召回、特征、打分、多样性依次截止，
+    前面阶段提前完成省下的时间自动留给后续阶段。超时的阶段记录在degraded中。
+    """
+
+    STAGES = ('recall', 'features', 'ranking', 'diversify')
+
+    def __init__(self, deadline_ms: float, shares: Optional[Dict[str, float]] = None):
+        shares = shares or {stage: 1.0 / len(self.STAGES) for stage in self.STAGES}
+        total_share = sum(shares[stage] for stage in self.STAGES) or 1.0
+        self.start = time.perf_counter()
+        self.deadline_ms = deadline_ms
+        self.deadlines: Dict[str, float] = {}
+        cumulative = 0.0
+        for stage in self.STAGES:
+            cumulative += shares[stage] / total_share
+            self.deadlines[stage] = self.start + deadline_ms / 1000 * min(cumulative, 1.0)
+        self.degraded: List[str] = []
+
+    def remaining(self, stage: str) -> float:
+        """距离该阶段截止的秒数"""
+        return max(0.0, self.deadlines[stage] - time.perf_counter())
+
+    def degrade(self, stage: str):
+        if stage not in self.degraded:
+            self.degraded.append(stage)
+            degraded_stage_counter.labels(stage=stage).inc()
+
 class RecommendationEngine:
     """推荐引擎核心"""
 
-    def __init__(self, feature_service, model_service, cache):
+    def __init__(self, feature_service, model_service, cache, local_cache=None,
+                 category_table: Optional[CategorySimilarityTable] = None,
+                 embedding_index: Optional[ItemEmbeddingIndex] = None,
+                 embedding_recall_size: int = 50, batch_concurrency: int = 16):
         self.feature_service = feature_service
         self.model_service = model_service
         self.cache = cache
-
-    async def recommend(self, request: RecommendationRequest) -> List[RecommendationItem]:
-        """生成推荐"""
-        # 1. 检查缓存
-        cached = await self.cache.get_cached_recommendations(
+        self.local_cache = local_cache
+        self.category_table = category_table or CategorySimilarityTable()
+        self.embedding_index = embedding_index
+        self.embedding_recall_size = embedding_recall_size
+        self.batch_concurrency = max(1, batch_concurrency)
+        # 所有批量请求共享的召回并发上限，多个批量请求同时到达时也不会占满Redis连接池
+        self._batch_semaphore = asyncio.Semaphore(self.batch_concurrency)
+        # 正在计算中的推荐（single-flight）：合并键 -> (任务, 发起请求的延迟预算)
+        self._inflight: Dict[tuple, Tuple[asyncio.Task, Optional[LatencyBudget]]] = {}
+
+    async def recommend(self, request: RecommendationRequest,
+                        budget: Optional[LatencyBudget] = None) -> List[RecommendationItem]:
+        """生成推荐，budget不为空时各阶段按预算超时降级，降级的阶段记录在budget.degraded"""
+        # 1. 检查缓存（先进程内L1，再Redis）
+        cached = await self._get_cached(request)
+        if cached is not None:
+            return cached
+
+        # 相同请求合并：并发的缓存未命中共享同一次计算（沿用发起请求的预算）
+        key = self._inflight_key(request, budget)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            coalesced_requests_counter.labels(page_type=request.page_type).inc()
+            task, owner_budget = inflight
+            if budget is None:
+                return list(await asyncio.shield(task))
+            # 跟随者按自己的预算等待，超时返回空结果（与整个预算用完时的降级结果一致）
+            try:
+                recommendations = list(await asyncio.wait_for(
+                    asyncio.shield(task), budget.remaining(LatencyBudget.STAGES[-1])
+                ))
+            except asyncio.TimeoutError:
+                budget.degrade('coalesced')
+                return []
+            budget.degraded.extend(s for s in owner_budget.degraded if s not in budget.degraded)
+            return recommendations
+
+        task = asyncio.ensure_future(self._compute_recommendations(request, budget))
+        self._inflight[key] = (task, budget)
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: 发起者被取消时不影响等待同一结果的其他请求
+        return list(await asyncio.shield(task))
+
+    async def _get_cached(self, request: RecommendationRequest) -> Optional[List[RecommendationItem]]:
+        """依次查询进程内L1缓存和Redis缓存"""
+        if self.local_cache is not None:
+            with stage_timer('cache_local'):
+                local = self.local_cache.get(request.user_id, request.page_type)
+            if local:
+                cache_lookup_counter.labels(layer='local', result='hit').inc()
+                return local
+            cache_lookup_counter.labels(layer='local', result='miss').inc()
+
+        cached = await timed_stage('cache_redis', self.cache.get_cached_recommendations(
             request.user_id, request.page_type
-        )
+        ))
         if cached:
-            return [RecommendationItem(**item) for item in cached]
+            cache_lookup_counter.labels(layer='redis', result='hit').inc()
+            if self.local_cache is not None:
+                self.local_cache.put(request.user_id, request.page_type, cached)
+            return cached
+        cache_lookup_counter.labels(layer='redis', result='miss').inc()
+        return None
+
+    async def _get_cached_many(self, requests: List[RecommendationRequest]
+                               ) -> List[Optional[List[RecommendationItem]]]:
+        """批量查询缓存：先逐个查L1，未命中的用一次MGET查Redis"""
+        results: List[Optional[List[RecommendationItem]]] = [None] * len(requests)
+        remote = []
+        for index, request in enumerate(requests):
+            local = None
+            if self.local_cache is not None:
+                local = self.local_cache.get(request.user_id, request.page_type)
+                cache_lookup_counter.labels(layer='local', result='hit' if local else 'miss').inc()
+            if local:
+                results[index] = local
+            else:
+                remote.append(index)
+        if not remote:
+            return results
+
+        cached_list = await timed_stage('cache_redis', self.cache.get_many_cached_recommendations(
+            [(requests[index].user_id, requests[index].page_type) for index in remote]
+        ))
+        for index, cached in zip(remote, cached_list):
+            request = requests[index]
+            if cached:
+                cache_lookup_counter.labels(layer='redis', result='hit').inc()
+                if self.local_cache is not None:
+                    self.local_cache.put(request.user_id, request.page_type, cached)
+                results[index] = cached
+            else:
+                cache_lookup_counter.labels(layer='redis', result='miss').inc()
+        return results
+
+    async def _store_recommendations(self, request: RecommendationRequest,
+                                     recommendations: List[RecommendationItem]):
+        """写入Redis缓存和进程内L1缓存"""
+        if not recommendations:
+            return
+        await self.cache.cache_recommendations(
+            request.user_id,
+            request.page_type,
+            recommendations
+        )
+        if self.local_cache is not None:
+            self.local_cache.put(request.user_id, request.page_type, recommendations)
+
+    @staticmethod
+    def _inflight_key(request: RecommendationRequest, budget: Optional[LatencyBudget] = None) -> tuple:
+        """single-flight合并键；有无预算分开合并，降级结果不会返回给未设置预算的请求"""
+        exclusions = tuple(sorted(set(request.exclude_item_ids or ())))
+        return (request.user_id, request.page_type, request.num_recommendations, exclusions,
+                budget is not None)
+
+    async def _compute_recommendations(self, request: RecommendationRequest,
+                                       budget: Optional[LatencyBudget] = None) -> List[RecommendationItem]:
+        """缓存未命中时计算推荐"""
+        ctx = self.new_context()
 
         # 2. 获取候选物品
-        candidates = await self.get_candidates(request)
+        candidates = await timed_stage('recall', self.get_candidates(request, ctx, budget))
 
-        # 3. 获取特征
-        user_features = await self.feature_service.get_user_features(request.user_id)
-        item_features = await self.feature_service.get_item_features(candidates)
+        # 3. 获取特征（召回阶段已读取的用户特征直接复用）
+        user_features, item_features = await self._get_features(request, candidates, ctx, budget)
 
         # 4. 模型预测
-        scores = await self.model_service.predict(user_features, item_features)
+        scores = await self._rank(request, user_features, item_features, budget)
 
-        # 5. 后处理
+        # 5. 后处理（预算已用完时跳过多样性处理）
+        diversify = budget is None or budget.remaining('diversify') > 0
+        if not diversify:
+            budget.degrade('diversify')
         recommendations = await self.post_process(
-            request, scores, user_features, item_features
+            request, scores, user_features, item_features, diversify=diversify
         )
 
-        # 6. 缓存结果
-        if recommendations:
-            await self.cache.cache_recommendations(
-                request.user_id,
-                request.page_type,
-                [r.dict() for r in recommendations]
-            )
+        # 6. 缓存结果（降级结果不缓存，下次请求重新计算完整结果）
+        if budget is None or not budget.degraded:
+            await self._store_recommendations(request, recommendations)
+
+        for backend, count in ctx.backend_reads.items():
+            request_backend_reads.labels(backend=backend).observe(count)
 
         return recommendations
 
-    async def get_candidates(self, request: RecommendationRequest) -> List[str]:
+    async def recommend_batch(
+            self, requests: List[RecommendationRequest]
+    ) -> AsyncIterator[Tuple[int, List[RecommendationItem]]]:
+        """批量生成推荐，按完成顺序逐个产出 (请求下标, 推荐列表)
+
+        缓存命中的请求先返回；其余请求共享一个请求上下文，候选物品去重后
+        只获取一次物品特征，所有用户-物品对在一个矩阵中一次打分。
+        """
+        cached_results = await self._get_cached_many(requests)
+        misses = []
+        for index, cached in enumerate(cached_results):
+            if cached is not None:
+                yield index, cached
+            else:
+                misses.append(index)
+        if not misses:
+            return
+
+        ctx = self.new_context()
+        miss_requests = [requests[index] for index in misses]
+
+        # 召回和用户特征：限制同时处理的用户数（跨批量请求共享），避免占满Redis连接池和Feast队列
+        async def recall(request: RecommendationRequest) -> Tuple[List[str], Dict]:
+            async with self._batch_semaphore:
+                candidates = await self.get_candidates(request, ctx)
+                user_features = await timed_stage('user_features', ctx.get_user_features(request.user_id))
+                return candidates, user_features
+
+        recalled = await asyncio.gather(*[recall(request) for request in miss_requests])
+        candidate_lists = [candidates for candidates, _ in recalled]
+        user_features_list = [user_features for _, user_features in recalled]
+
+        # 物品特征：候选物品跨用户去重后一次获取
+        all_item_features = await timed_stage('item_features', ctx.get_item_features(
+            list(dict.fromkeys(itertools.chain.from_iterable(candidate_lists)))
+        ))
+        item_features_list = [
+            {item_id: all_item_features[item_id] for item_id in candidates}
+            for candidates in candidate_lists
+        ]
+
+        # 一次打分（同步计算，放到打分线程池中避免阻塞事件循环）
+        try:
+            scores_list = await self.model_service.run_scoring(
+                self.model_service.score_batch, user_features_list, item_features_list,
+                user_ids=[request.user_id for request in miss_requests]
+            )
+        except RuntimeError as e:
+            logger.warning(f"Batch scoring degraded: {e}")
+            scores_list = [self.model_service.fallback_predict(item_features)
+                           for item_features in item_features_list]
+
+        # 逐用户后处理并返回
+        for index, request, user_features, item_features, scores in zip(
+                misses, miss_requests, user_features_list, item_features_list, scores_list):
+            recommendations = await self.post_process(
+                request, scores, user_features, item_features
+            )
+            await self._store_recommendations(request, recommendations)
+            yield index, recommendations
+
+        for backend, count in ctx.backend_reads.items():
+            request_backend_reads.labels(backend=backend).observe(count)
+
+    async def _get_features(self, request: RecommendationRequest, candidates: List[str],
+                            ctx: RequestContext, budget: Optional[LatencyBudget]
+                            ) -> Tuple[Dict, Dict[str, Dict]]:
+        """获取用户和候选物品特征，超出预算的部分使用默认值（空特征）"""
+        if budget is None:
+            user_features = await timed_stage('user_features', ctx.get_user_features(request.user_id))
+            item_features = await timed_stage('item_features', ctx.get_item_features(candidates))
+            return user_features, item_features
+
+        user_task = asyncio.ensure_future(
+            timed_stage('user_features', ctx.get_user_features(request.user_id))
+        )
+        item_task = asyncio.ensure_future(
+            timed_stage('item_features', ctx.get_item_features(candidates))
+        )
+        _, pending = await asyncio.wait([user_task, item_task], timeout=budget.remaining('features'))
+        for task in pending:
+            task.cancel()
+        if pending:
+            budget.degrade('features')
+
+        user_features = {} if user_task in pending else user_task.result()
+        item_features = (
+            {item_id: {} for item_id in candidates} if item_task in pending else item_task.result()
+        )
+        return user_features, item_features
+
+    async def _rank(self, request: RecommendationRequest, user_features: Dict,
+                    item_features: Dict[str, Dict], budget: Optional[LatencyBudget]) -> Dict[str, float]:
+        """模型打分，超出预算时改用流行度降级打分"""
+        if budget is None:
+            return await self.model_service.predict(user_features, item_features, user_id=request.user_id)
+
+        remaining = budget.remaining('ranking')
+        if remaining > 0:
+            # 打分是同步计算，放到线程池中才能按预算超时
+            try:
+                return await asyncio.wait_for(self.model_service.run_scoring(
+                    self.model_service.score, user_features, item_features, user_id=request.user_id
+                ), remaining)
+            except (asyncio.TimeoutError, RuntimeError):
+                pass
+        budget.degrade('ranking')
+        return self.model_service.fallback_predict(item_features)
+
+    def new_context(self) -> RequestContext:
+        """创建请求级上下文"""
+        return RequestContext(self.feature_service, self.feature_service.redis)
+
+    async def get_candidates(self, request: RecommendationRequest,
+                             ctx: Optional[RequestContext] = None,
+                             budget: Optional[LatencyBudget] = None) -> List[str]:
         """获取候选物品"""
-        # 多路召回
-        candidates = set()
+        ctx = ctx or self.new_context()
+
+        # 多路召回（各路并发执行）
+        routes = {
+            # 路1: 用户最近交互过的相似物品
+            'recent_similar': self.get_recent_similar_items(request.user_id, ctx),
+            # 路2: 热门物品
+            'popular': self.get_popular_items(request.page_type, ctx),
+            # 路3: 基于类目的物品
+            'category': self.get_category_based_items(request.user_id, ctx),
+            # 路4: 向量召回
+            'embedding': self.get_embedding_based_items(request.user_id, ctx),
+        }
+        if budget is None:
+            results = await asyncio.gather(
+                *[self._timed_recall(route, coro) for route, coro in routes.items()]
+            )
+        else:
+            # 超出召回预算的路直接丢弃，用已完成的路继续
+            tasks = [asyncio.ensure_future(self._timed_recall(route, coro))
+                     for route, coro in routes.items()]
+            _, pending = await asyncio.wait(tasks, timeout=budget.remaining('recall'))
+            results = []
+            for route, task in zip(routes, tasks):
+                if task in pending:
+                    task.cancel()
+                    budget.degrade(f'recall:{route}')
+                    results.append([])
+                else:
+                    results.append(task.result())
+        recent, popular, category_based, embedding_based = results
 
-        # 路1: 用户最近交互过的相似物品
-        recent = await self.get_recent_similar_items(request.user_id)
+        candidates = set()
         candidates.update(recent)
-
-        # 路2: 热门物品
-        popular = await self.get_popular_items(request.page_type)
         candidates.update(popular)
-
-        # 路3: 基于类目的物品
-        category_based = await self.get_category_based_items(request.user_id)
         candidates.update(category_based)
+        candidates.update(embedding_based)
 
         # 移除排除的物品
         if request.exclude_item_ids:
@@ -396,57 +1953,79 @@ class RecommendationEngine:
 
         return list(candidates)[:200]  # 限制候选集大小
 
-    async def get_recent_similar_items(self, user_id: str) -> List[str]:
+    async def _timed_recall(self, route: str, coro) -> List[str]:
+        """执行单路召回并记录耗时"""
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            recall_route_latency.labels(route=route).observe(time.perf_counter() - start)
+
+    async def get_recent_similar_items(self, user_id: str, ctx: RequestContext) -> List[str]:
         """获取最近交互物品的相似物品"""
         # 从Redis获取用户最近交互
         user_key = f"user:{user_id}:realtime"
-        recent_items = await self.cache.redis.lrange(f"{user_key}:recent_items", 0, 5)
+        recent_items = await ctx.lrange(f"{user_key}:recent_items", 0, 5)
 
         if not recent_items:
             return []
 
         # 从Redis获取相似物品（预计算的ItemCF结果）
-        similar_items = []
-        for item_id in recent_items:
-            sim_key = f"item:{item_id}:similar"
-            sims = await self.cache.redis.zrevrange(sim_key, 0, 10)
-            similar_items.extend(sims)
+        sim_keys = [f"item:{item_id}:similar" for item_id in recent_items]
+        return await ctx.zrevrange_many(sim_keys, 10)
 
-        return similar_items
-
-    async def get_popular_items(self, page_type: str) -> List[str]:
+    async def get_popular_items(self, page_type: str, ctx: RequestContext) -> List[str]:
         """获取热门物品"""
         popular_key = f"popular:{page_type}"
-        popular = await self.cache.redis.zrevrange(popular_key, 0, 100)
-        return popular
+        return await ctx.zrevrange_many([popular_key], 100)
 
-    async def get_category_based_items(self, user_id: str) -> List[str]:
+    async def get_category_based_items(self, user_id: str, ctx: RequestContext) -> List[str]:
         """获取基于用户偏好类目的物品"""
         # 获取用户top品类
-        user_features = await self.feature_service.get_user_features(user_id)
+        user_features = await ctx.get_user_features(user_id)
         top_categories = user_features.get('top_categories', [])
 
         if not top_categories:
             return []
 
         # 从每个品类取一些物品
-        items = []
-        for category in top_categories[:3]:
-            cat_key = f"category:{category}:items"
-            cat_items = await self.cache.redis.zrevrange(cat_key, 0, 30)
-            items.extend(cat_items)
+        cat_keys = [f"category:{category}:items" for category in top_categories[:3]]
+        return await ctx.zrevrange_many(cat_keys, 30)
 
-        return items
+    async def get_embedding_based_items(self, user_id: str, ctx: RequestContext) -> List[str]:
+        """向量召回：以最近交互物品向量的均值检索相似物品
+
+        最近交互列表与路1共用同一次Redis读取，检索在进程内完成。
+        """
+        if self.embedding_index is None or self.embedding_recall_size <= 0 or not len(self.embedding_index):
+            return []
+
+        recent_items = await ctx.lrange(f"user:{user_id}:realtime:recent_items", 0, 5)
+        query = self.embedding_index.user_vector(recent_items)
+        if query is None:
+            return []
+
+        recent = set(recent_items)
+        k = self.embedding_recall_size + len(recent)
+        return [item_id for item_id in self.embedding_index.search(query, k)
+                if item_id not in recent][:self.embedding_recall_size]
 
     async def post_process(self, request: RecommendationRequest, scores: Dict[str, float],
-                          user_features: Dict, item_features: Dict) -> List[RecommendationItem]:
+                          user_features: Dict, item_features: Dict,
+                          diversify: bool = True) -> List[RecommendationItem]:
         """后处理：多样性、过滤等"""
 
         # 按得分排序
         sorted_items = sorted(scores.items(), key=lambda x: x[1], reverse=True)
 
-        # 多样性处理（MMR算法）
-        final_items = self.diversify(sorted_items, user_features, item_features)
+        # 多样性处理（MMR算法），lambda可由请求上下文指定（多样性AB实验）
+        final_items = sorted_items
+        if diversify:
+            lambda_param = self._mmr_lambda(request.context)
+            with stage_timer('diversify'):
+                final_items = self.diversify(
+                    sorted_items, user_features, item_features, lambda_param=lambda_param
+                )
 
         # 截取需要的数量
         final_items = final_items[:request.num_recommendations]
@@ -465,41 +2044,62 @@ class RecommendationEngine:
 
         return recommendations
 
+    @staticmethod
+    def _mmr_lambda(context: Optional[Dict[str, Any]], default: float = 0.5) -> float:
+        """从请求上下文读取MMR的lambda，转为[0, 1]内的浮点数，无法解析时用默认值"""
+        value = (context or {}).get('mmr_lambda', default)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return default
+        if not np.isfinite(value):
+            return default
+        return min(max(value, 0.0), 1.0)
+
     def diversify(self, sorted_items, user_features, item_features, lambda_param=0.5):
-        """MMR多样性重排序"""
-        selected = []
-        candidates = sorted_items.copy()
+        """MMR多样性重排序
 
-        if not candidates:
+        维护每个候选与已选集合的最大相似度向量，每选出一个物品只需用它的
+        相似度行增量更新，结果与逐对计算calculate_similarity的实现一致。
+        """
+        if not sorted_items:
             return []
 
-        # 选择第一个
-        selected.append(candidates[0])
-        candidates = candidates[1:]
-
-        while len(selected) < min(50, len(sorted_items)) and candidates:
-            max_score = -float('inf')
-            best_item = None
-
-            for item_id, score in candidates:
-                # 计算与已选物品的最大相似度
-                max_sim = 0
-                for sel_id, _ in selected:
-                    sim = self.calculate_similarity(item_id, sel_id, item_features)
-                    max_sim = max(max_sim, sim)
-
-                # MMR公式: lambda * 相关度 - (1-lambda) * 最大相似度
-                mmr_score = lambda_param * score - (1 - lambda_param) * max_sim
-
-                if mmr_score > max_score:
-                    max_score = mmr_score
-                    best_item = (item_id, score)
+        limit = min(50, len(sorted_items))
+        item_ids = [item_id for item_id, _ in sorted_items]
+        relevance = np.array([score for _, score in sorted_items], dtype=np.float64)
+        codes = self._category_codes(item_ids, item_features)
+        similarity = self.category_table.matrix
 
-            if best_item:
-                selected.append(best_item)
-                candidates.remove(best_item)
+        # MMR公式: lambda * 相关度 - (1-lambda) * 最大相似度
+        weighted_relevance = lambda_param * relevance
+        max_sim = np.zeros(len(sorted_items), dtype=np.float64)
+        available = np.ones(len(sorted_items), dtype=bool)
 
-        return selected
+        # 选择第一个
+        order = [0]
+        available[0] = False
+
+        while len(order) < limit:
+            max_sim = np.maximum(max_sim, similarity[codes, codes[order[-1]]])
+            mmr_scores = weighted_relevance - (1 - lambda_param) * max_sim
+            mmr_scores[~available] = -np.inf
+            best = int(np.argmax(mmr_scores))  # 得分相同时取排序靠前的物品
+            order.append(best)
+            available[best] = False
+
+        return [sorted_items[i] for i in order]
+
+    def _category_codes(self, item_ids, item_features) -> np.ndarray:
+        """候选物品的品类编码（优先使用获取特征时已编码的结果）"""
+        codes = np.empty(len(item_ids), dtype=np.int64)
+        for i, item_id in enumerate(item_ids):
+            feat = item_features.get(item_id, {})
+            code = feat.get('category_code')
+            if code is None:
+                code = self.category_table.encode(feat.get('category', ''))
+            codes[i] = code
+        return codes
 
     def calculate_similarity(self, item_id1, item_id2, item_features):
         """计算两个物品的相似度（基于特征）"""
@@ -509,25 +2109,291 @@ class RecommendationEngine:
         # 使用品类相似度
         cat1 = feat1.get('category', '')
         cat2 = feat2.get('category', '')
-
-        if cat1 == cat2:
-            return 0.8
-        elif cat1 and cat2 and cat1[:3] == cat2[:3]:  # 同大类
-            return 0.5
-        else:
-            return 0.1
+        return self.category_table.similarity(cat1, cat2)
 
     def generate_reason(self, item_id, user_features, item_features):
         """生成推荐理由"""
         recent_items = user_features.get('recent_items', [])
 
         if recent_items and item_id in recent_items:
-            return "因为您最近浏览过类似商品"
+            return REASON_RECENT_SIMILAR
 
         if item_features.get(item_id, {}).get('purchase_rate', 0) > 0.1:
-            return "热门推荐"
+            return REASON_POPULAR
+
+        return REASON_GUESS
+
+# ============ 事件上报 ============
 
-        return "猜你喜欢"
+class ABCounterBuffer:
+    """AB测试计数缓冲
+
+    计数先在进程内累加，再以pipeline批量INCRBY写入AB测试Redis。调用方通过
+    max_delay指定可接受的最长延迟，缓冲区按所有待写计数中最早的截止时间刷新；
+    max_delay为0时立即写入。
+    """
+
+    def __init__(self, redis_client: Redis, flush_interval: float = 1.0):
+        self.redis = redis_client
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, int] = {}
+        self._deadline: Optional[float] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: set = set()
+
+    async def incr(self, key: str, amount: int = 1, max_delay: Optional[float] = None):
+        """累加计数，最迟在max_delay秒后写入Redis"""
+        self._pending[key] = self._pending.get(key, 0) + amount
+        delay = self.flush_interval if max_delay is None else max_delay
+        if delay <= 0:
+            await self.flush()
+        else:
+            self._schedule(delay)
+
+    def _schedule(self, delay: float):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        if self._timer is not None:
+            if self._deadline <= deadline:
+                return
+            self._timer.cancel()
+        self._deadline = deadline
+        self._timer = loop.call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        self._deadline = None
+        task = asyncio.ensure_future(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def flush(self):
+        """以一个pipeline写入全部待写计数"""
+        if not self._pending:
+            return
+
+        counts, self._pending = self._pending, {}
+        pipe = self.redis.pipeline(transaction=False)
+        for key, amount in counts.items():
+            pipe.incrby(key, amount)
+        try:
+            await pipe.execute()
+        except Exception as e:
+            # 写入失败时把计数放回缓冲区，稍后重试
+            logger.error(f"AB counter flush error: {e}")
+            for key, amount in counts.items():
+                self._pending[key] = self._pending.get(key, 0) + amount
+            self._schedule(self.flush_interval)
+
+    async def close(self):
+        """取消定时刷新并写入剩余计数"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._deadline = None
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        await self.flush()
+
+class KafkaEventProducer:
+    """共享的Kafka事件生产者
+
+    由lifespan创建并在整个应用生命周期内复用，消息在生产者内部按
+    linger_ms/max_batch_size攒批发送，关闭时会先将缓冲区中的消息全部发出。
+    """
+
+    def __init__(self, bootstrap_servers: str, topic: str = "user-events",
+                 linger_ms: int = 5, max_batch_size: int = 65536,
+                 compression_type: Optional[str] = None):
+        self.bootstrap_servers = bootstrap_servers
+        self.topic = topic
+        self.linger_ms = linger_ms
+        self.max_batch_size = max_batch_size
+        self.compression_type = compression_type
+        self._producer: Optional[AIOKafkaProducer] = None
+        self._start_lock = asyncio.Lock()
+        self._pending = 0
+
+    async def start(self):
+        """启动生产者；Kafka不可用时不阻止应用启动，发送时会重试连接"""
+        try:
+            await self._ensure_started()
+        except Exception as e:
+            logger.error(f"Kafka producer start failed: {e}")
+
+    async def _ensure_started(self) -> AIOKafkaProducer:
+        async with self._start_lock:
+            if self._producer is None:
+                producer = AIOKafkaProducer(
+                    bootstrap_servers=self.bootstrap_servers,
+                    linger_ms=self.linger_ms,
+                    max_batch_size=self.max_batch_size,
+                    compression_type=self.compression_type
+                )
+                try:
+                    await producer.start()
+                except Exception:
+                    await producer.stop()
+                    raise
+                self._producer = producer
+        return self._producer
+
+    async def send(self, event: Dict) -> asyncio.Future:
+        """发送事件：写入生产者缓冲区后返回，投递结果由返回的future给出"""
+        producer = self._producer or await self._ensure_started()
+        value = json.dumps(event).encode()
+
+        start = time.perf_counter()
+        self._pending += 1
+        kafka_pending_gauge.set(self._pending)
+        try:
+            future = await producer.send(self.topic, value)
+        except Exception:
+            self._pending -= 1
+            kafka_pending_gauge.set(self._pending)
+            raise
+        future.add_done_callback(functools.partial(self._on_delivered, start))
+        return future
+
+    async def send_batch(self, events: List[Dict]):
+        """将多条事件打包成尽量少的Kafka批次写入（同一批次发往同一分区）"""
+        if not events:
+            return
+        producer = self._producer or await self._ensure_started()
+        partitions = sorted(await producer.partitions_for(self.topic))
+        partition = random.choice(partitions)
+
+        batch = producer.create_batch()
+        for event in events:
+            value = json.dumps(event).encode()
+            if batch.append(key=None, value=value, timestamp=None) is not None:
+                continue
+            # 当前批次已满，发出后新开一个批次
+            if batch.record_count():
+                await self._send_built_batch(producer, batch, partition)
+                batch = producer.create_batch()
+            if batch.append(key=None, value=value, timestamp=None) is None:
+                await self.send(event)  # 单条消息超过批次上限，单独发送
+        if batch.record_count():
+            await self._send_built_batch(producer, batch, partition)
+
+    async def _send_built_batch(self, producer: AIOKafkaProducer, batch, partition: int):
+        count = batch.record_count()
+        start = time.perf_counter()
+        self._pending += count
+        kafka_pending_gauge.set(self._pending)
+        try:
+            future = await producer.send_batch(batch, self.topic, partition=partition)
+        except Exception:
+            self._pending -= count
+            kafka_pending_gauge.set(self._pending)
+            raise
+        future.add_done_callback(functools.partial(self._on_delivered, start, count=count))
+
+    def _on_delivered(self, start: float, future: asyncio.Future, count: int = 1):
+        self._pending -= count
+        kafka_pending_gauge.set(self._pending)
+        kafka_send_latency.observe(time.perf_counter() - start)
+        if not future.cancelled() and future.exception() is not None:
+            kafka_send_errors_counter.inc(count)
+            logger.error(f"Kafka delivery failed: {future.exception()}")
+
+    async def stop(self):
+        """发送缓冲区中的全部消息后关闭生产者"""
+        if self._producer is not None:
+            try:
+                await self._producer.flush()
+            finally:
+                await self._producer.stop()
+                self._producer = None
+
+class ImpressionLogger:
+    """曝光微批记录器
+
+    汇总所有请求的曝光，按条数或时间间隔合并为一条Kafka消息发送。
+    每个推荐响应压缩为一条记录（物品位置即item_ids中的下标）。
+    缓冲区有上限，满时按overflow_policy丢弃（drop）或等待（block）。
+    """
+
+    def __init__(self, producer: KafkaEventProducer, batch_size: int = 500,
+                 flush_interval: float = 1.0, buffer_size: int = 20000,
+                 overflow_policy: str = "drop"):
+        if overflow_policy not in ("drop", "block"):
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.producer = producer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.overflow_policy = overflow_policy
+        self._buffer: List[Dict] = []
+        self._flush_requested = asyncio.Event()
+        self._space_available = asyncio.Event()
+        self._space_available.set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def log(self, user_id: str, recommendations: List[RecommendationItem]):
+        """记录一次推荐响应的曝光"""
+        if not recommendations:
+            return
+
+        while len(self._buffer) >= self.buffer_size:
+            if self.overflow_policy == "drop":
+                impressions_dropped_counter.inc(len(recommendations))
+                return
+            self._space_available.clear()
+            await self._space_available.wait()
+
+        self._buffer.append({
+            "user_id": user_id,
+            "item_ids": [rec.item_id for rec in recommendations],
+            "timestamp": datetime.now().timestamp()
+        })
+        impression_buffer_gauge.set(len(self._buffer))
+        if len(self._buffer) >= self.batch_size:
+            self._flush_requested.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    async def flush(self):
+        """将缓冲区中的曝光全部发送"""
+        while self._buffer:
+            records = self._buffer[:self.batch_size]
+            del self._buffer[:self.batch_size]
+            impression_buffer_gauge.set(len(self._buffer))
+            self._space_available.set()
+
+            start = time.perf_counter()
+            try:
+                await self.producer.send({
+                    "action": "impression_batch",
+                    "version": 1,
+                    "records": records
+                })
+            except Exception as e:
+                logger.error(f"Impression flush error: {e}")
+                impressions_dropped_counter.inc(sum(len(r["item_ids"]) for r in records))
+            finally:
+                impression_flush_latency.observe(time.perf_counter() - start)
+
+    async def stop(self):
+        """停止后台刷新并发送剩余曝光"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
 
 # ============ FastAPI应用 ============
 
@@ -536,23 +2402,132 @@ async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     # 启动时
     app.state.redis = await aioredis.from_url(settings.redis_url, decode_responses=True)
-    app.state.cache = RecommendationCache(app.state.redis)
-    app.state.feature_service = FeatureService(settings.feature_store_path, app.state.redis)
+    # 推荐缓存存放二进制编码，使用不解码响应的独立连接
+    app.state.cache_redis = await aioredis.from_url(settings.redis_url)
+    app.state.cache = RecommendationCache(
+        app.state.cache_redis,
+        RecommendationCodec(compress_threshold=settings.cache_compress_threshold)
+    )
+    app.state.local_cache = LocalRecommendationCache(
+        max_size=settings.local_cache_size,
+        ttl=settings.local_cache_ttl
+    )
+    app.state.invalidation_task = asyncio.create_task(
+        app.state.local_cache.listen_invalidations(app.state.redis)
+    )
+    app.state.category_table = CategorySimilarityTable(
+        same_category=settings.category_sim_same,
+        same_group=settings.category_sim_group,
+        other=settings.category_sim_other
+    )
+    app.state.feature_service = FeatureService(
+        settings.feature_store_path,
+        app.state.redis,
+        max_concurrency=settings.feature_store_max_concurrency,
+        max_queue=settings.feature_store_max_queue,
+        category_table=app.state.category_table
+    )
+    app.state.item_snapshot_task = None
+    if settings.item_snapshot_path:
+        try:
+            app.state.feature_service.load_item_snapshot(settings.item_snapshot_path)
+        except Exception as e:
+            logger.error(f"Error loading item feature snapshot: {e}")
+        if settings.item_snapshot_watch_interval > 0:
+            app.state.item_snapshot_task = asyncio.create_task(
+                app.state.feature_service.watch_item_snapshot(
+                    settings.item_snapshot_path, settings.item_snapshot_watch_interval
+                )
+            )
+    # 其他worker已回滚的版本不再加载；Redis不可用时先按空集合启动，由回滚订阅在连上后补齐
+    rolled_back_key = MODEL_ROLLED_BACK_KEY.format(model_name=settings.model_name)
+    try:
+        rolled_back_versions = set(await app.state.redis.smembers(rolled_back_key))
+    except Exception as e:
+        logger.warning(f"Could not read rolled back model versions: {e}")
+        rolled_back_versions = set()
     app.state.model_service = ModelService(
         settings.model_path,
         settings.model_name,
-        settings.model_version
+        settings.model_version,
+        max_batch_size=settings.model_max_batch_size,
+        scorer=settings.model_scorer,
+        rolled_back_versions=rolled_back_versions,
+        max_concurrency=settings.model_scoring_max_concurrency,
+        max_queue=settings.model_scoring_max_queue
+    )
+    app.state.model_rollback_task = asyncio.create_task(
+        app.state.model_service.listen_rollbacks(app.state.redis)
     )
+    app.state.model_watch_task = None
+    if settings.model_version == 'latest' and settings.model_watch_interval > 0:
+        app.state.model_watch_task = asyncio.create_task(
+            app.state.model_service.watch(settings.model_watch_interval)
+        )
+    app.state.embedding_index = ItemEmbeddingIndex(
+        app.state.redis,
+        n_lists=settings.embedding_index_lists,
+        nprobe=settings.embedding_index_nprobe
+    )
+    app.state.embedding_index_task = None
+    if settings.embedding_recall_size > 0:
+        # 索引在后台构建，构建完成前向量召回路返回空
+        app.state.embedding_index_task = asyncio.create_task(
+            app.state.embedding_index.run(settings.embedding_index_rebuild_interval)
+        )
     app.state.engine = RecommendationEngine(
         app.state.feature_service,
         app.state.model_service,
-        app.state.cache
+        app.state.cache,
+        local_cache=app.state.local_cache,
+        category_table=app.state.category_table,
+        embedding_index=app.state.embedding_index,
+        embedding_recall_size=settings.embedding_recall_size,
+        batch_concurrency=settings.recommend_batch_concurrency
+    )
+
+    app.state.event_producer = KafkaEventProducer(
+        settings.kafka_broker,
+        topic=settings.kafka_topic,
+        linger_ms=settings.kafka_linger_ms,
+        max_batch_size=settings.kafka_max_batch_size,
+        compression_type=settings.kafka_compression_type
+    )
+    await app.state.event_producer.start()
+    app.state.impression_logger = ImpressionLogger(
+        app.state.event_producer,
+        batch_size=settings.impression_batch_size,
+        flush_interval=settings.impression_flush_interval,
+        buffer_size=settings.impression_buffer_size,
+        overflow_policy=settings.impression_overflow_policy
+    )
+    app.state.impression_logger.start()
+    app.state.ab_redis = await aioredis.from_url(settings.ab_redis_url, decode_responses=True)
+    app.state.ab_counters = ABCounterBuffer(
+        app.state.ab_redis,
+        flush_interval=settings.ab_flush_interval
     )
 
     logger.info("Application started")
     yield
 
     # 关闭时
+    for task in (app.state.invalidation_task, app.state.model_watch_task, app.state.model_rollback_task,
+                 app.state.embedding_index_task, app.state.item_snapshot_task):
+        if task is None:
+            continue
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await app.state.ab_counters.close()
+    await app.state.ab_redis.close()
+    await app.state.impression_logger.stop()
+    await app.state.event_producer.stop()
+    app.state.feature_service.close()
+    app.state.model_service.close()
+    await app.state.cache_redis.close()
     await app.state.redis.close()
     logger.info("Application shutdown")
 
@@ -581,30 +2556,46 @@ async def health_check():
 
 @app.get("/metrics")
 async def metrics():
-    """Prometheus监控指标"""
-    return generate_latest()
+    """Prometheus监控指标
+
+    CONTENT_TYPE_LATEST已带charset，通过media_type传入时starlette会再追加一次，
+    严格的抓取端会拒绝，因此直接设置响应头。
+    """
+    return Response(generate_latest(), headers={"Content-Type": prometheus_client.CONTENT_TYPE_LATEST})
 
 @app.post("/api/v1/recommend", response_model=RecommendationResponse)
 async def get_recommendations(
     request: RecommendationRequest,
     background_tasks: BackgroundTasks,
-    request_obj: Request
+    request_obj: Request,
+    deadline_ms: Optional[float] = Header(None, alias="X-Request-Deadline-Ms")
 ):
     """获取推荐"""
-    start_time = datetime.now()
+    start_time = time.perf_counter()
+
+    # 延迟预算：请求头优先，其次配置，0为不限
+    deadline_ms = deadline_ms if deadline_ms is not None else settings.request_deadline_ms
+    budget = None
+    if deadline_ms > 0:
+        budget = LatencyBudget(deadline_ms, {
+            'recall': settings.budget_share_recall,
+            'features': settings.budget_share_features,
+            'ranking': settings.budget_share_ranking,
+            'diversify': settings.budget_share_diversify,
+        })
 
     # 记录请求指标
     recommendation_counter.labels(
         page_type=request.page_type,
-        model_version=settings.model_version
+        model_version=request_obj.app.state.model_service.model_version
     ).inc()
 
     try:
         # 生成推荐
-        recommendations = await request_obj.app.state.engine.recommend(request)
+        recommendations = await request_obj.app.state.engine.recommend(request, budget)
 
         # 计算处理时间
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
+        processing_time = (time.perf_counter() - start_time) * 1000
         recommendation_latency.labels(request.page_type).observe(processing_time / 1000)
 
         # 异步记录曝光
@@ -615,37 +2606,80 @@ async def get_recommendations(
             request_obj
         )
 
-        return RecommendationResponse(
+        response = RecommendationResponse(
             user_id=request.user_id,
             request_id=generate_request_id(),
             recommendations=recommendations,
             processing_time_ms=processing_time,
-            model_version=settings.model_version
+            model_version=request_obj.app.state.model_service.model_version,
+            degraded_stages=list(budget.degraded) if budget else []
         )
+        # 自行序列化以便计时，直接返回Response时FastAPI不会再次校验和编码
+        with stage_timer('serialization'):
+            body = response.json()
+        return Response(content=body, media_type="application/json")
 
     except Exception as e:
         logger.error(f"Recommendation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/v1/recommend/batch")
+async def get_batch_recommendations(requests: List[RecommendationRequest], request_obj: Request):
+    """批量获取推荐（邮件/推送等离线任务用，不记录曝光）
+
+    结果按完成顺序以NDJSON逐行返回，每行一个RecommendationResponse。
+    """
+    if len(requests) > settings.recommend_batch_max_size:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.recommend_batch_max_size} requests per batch"
+        )
+
+    model_service = request_obj.app.state.model_service
+    for request in requests:
+        recommendation_counter.labels(
+            page_type=request.page_type,
+            model_version=model_service.model_version
+        ).inc()
+
+    async def stream():
+        start = time.perf_counter()
+        try:
+            async for index, recommendations in request_obj.app.state.engine.recommend_batch(requests):
+                response = RecommendationResponse(
+                    user_id=requests[index].user_id,
+                    request_id=generate_request_id(),
+                    recommendations=recommendations,
+                    processing_time_ms=(time.perf_counter() - start) * 1000,
+                    model_version=model_service.model_version
+                )
+                with stage_timer('serialization'):
+                    line = response.json() + "\n"
+                yield line
+        except Exception as e:
+            logger.error(f"Batch recommendation error: {e}")
+            yield json.dumps({"status": "error", "message": str(e)}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 @app.post("/api/v1/events")
-async def track_event(event: TrackEventRequest):
+async def track_event(event: TrackEventRequest, request: Request):
     """跟踪用户事件"""
     try:
         # 存储事件到Kafka
-        await send_to_kafka(event)
+        await send_to_kafka(request.app.state.event_producer, event)
 
         # 更新指标
         if event.action == "impression":
-            item_impression_counter.labels(
-                item_id=event.item_id,
-                page_type="all"
-            ).inc()
+            item_impression_counter.inc()
         elif event.action == "click":
-            item_click_counter.labels(item_id=event.item_id).inc()
+            item_click_counter.inc()
+        item_heavy_hitters.record(event.action, event.item_id)
 
         # 如果有request_id，记录到AB测试
         if event.request_id:
-            await record_ab_test_event(event)
+            await record_ab_test_event(request.app.state.ab_counters, event,
+                                       max_delay=ab_test_flush_delay(event))
 
         return {"status": "success"}
 
@@ -653,12 +2687,162 @@ async def track_event(event: TrackEventRequest):
         logger.error(f"Event tracking error: {e}")
         return {"status": "error", "message": str(e)}
 
+@app.post("/api/v1/events/batch")
+async def track_events_batch(request: Request):
+    """批量跟踪用户事件
+
+    请求体为事件的JSON数组，或Content-Type为application/x-ndjson时每行一个事件
+    （空行忽略，下标为请求体中从0开始的行号）。无法解析或校验失败的事件在rejected中按下标返回，
+    其余事件一次性批量写入Kafka，指标和AB计数按聚合后的结果更新。
+    """
+    body = await request.body()
+    parse_errors: Dict[int, str] = {}
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        # 逐行解析，单行格式错误不影响其他事件；先编号再跳过空行，下标与请求体的行号一致
+        raw_events = []
+        for index, line in enumerate(body.splitlines()):
+            if not line.strip():
+                continue
+            try:
+                raw_events.append((index, json.loads(line)))
+            except ValueError as e:
+                parse_errors[index] = f"Invalid JSON: {e}"
+                raw_events.append((index, None))
+    else:
+        try:
+            raw_events = json.loads(body)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
+        if not isinstance(raw_events, list):
+            raise HTTPException(status_code=400, detail="Request body must be a list of events")
+        raw_events = list(enumerate(raw_events))
+    if len(raw_events) > settings.events_batch_max_size:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.events_batch_max_size} events per batch"
+        )
+
+    events = []
+    rejected = []
+    for index, raw in raw_events:
+        if index in parse_errors:
+            rejected.append({"index": index, "error": parse_errors[index]})
+            continue
+        try:
+            events.append(TrackEventRequest.parse_obj(raw))
+        except Exception as e:
+            rejected.append({"index": index, "error": str(e)})
+
+    try:
+        # 一次批量写入Kafka
+        await send_events_to_kafka(
+            request.app.state.event_producer,
+            [event.dict() for event in events]
+        )
+
+        # 聚合更新指标
+        actions = CollectionCounter(event.action for event in events)
+        item_impression_counter.inc(actions["impression"])
+        item_click_counter.inc(actions["click"])
+        for (action, item_id), count in CollectionCounter(
+                (event.action, event.item_id) for event in events).items():
+            item_heavy_hitters.record(action, item_id, count)
+
+        # 聚合记录AB测试计数
+        ab_counts = CollectionCounter()
+        ab_delays: Dict[str, Optional[float]] = {}
+        for event in events:
+            key = ab_test_counter_key(event)
+            if key is not None:
+                ab_counts[key] += 1
+                ab_delays[key] = ab_test_flush_delay(event)
+        for key, count in ab_counts.items():
+            await request.app.state.ab_counters.incr(key, count, max_delay=ab_delays[key])
+
+        return {"status": "success", "accepted": len(events), "rejected": rejected}
+
+    except Exception as e:
+        logger.error(f"Batch event tracking error: {e}")
+        return {"status": "error", "message": str(e), "rejected": rejected}
+
+@app.get("/api/v1/metrics/items/sketch")
+async def get_item_sketch():
+    """导出物品曝光/点击的完整统计（离线分析用）"""
+    return item_heavy_hitters.dump()
+
 @app.post("/api/v1/refresh/{user_id}")
 async def refresh_user_recommendations(user_id: str, request: Request):
     """刷新用户推荐缓存（有新行为时调用）"""
     await request.app.state.cache.invalidate_user_cache(user_id)
+    request.app.state.local_cache.invalidate_user(user_id)
     return {"status": "success", "message": f"Cache invalidated for user {user_id}"}
 
+@app.get("/api/v1/model")
+async def get_model_info(request: Request):
+    """当前模型版本信息"""
+    model_service = request.app.state.model_service
+    return {
+        "model_name": model_service.model_name,
+        "active_version": model_service.active.version if model_service.active else None,
+        "previous_version": model_service.previous.version if model_service.previous else None,
+        "scorer": type(model_service.model).__name__ if model_service.model is not None else None,
+    }
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """管理接口鉴权：未配置admin_token时一律拒绝"""
+    if not settings.admin_token or x_admin_token != settings.admin_token:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@app.post("/api/v1/model/rollback", dependencies=[Depends(require_admin)])
+async def rollback_model(request: Request):
+    """回滚当前模型版本
+
+    当前worker先切换，成功后记录到已回滚集合并广播，其他worker收到后一起回滚，
+    之后启动的worker也不会再加载该版本（从集合中删除即可恢复）。
+    """
+    model_service = request.app.state.model_service
+    version = model_service.active.version if model_service.active else None
+    if version is None or not await model_service.rollback_version(version):
+        raise HTTPException(status_code=409, detail="No previous model version to roll back to")
+
+    redis = request.app.state.redis
+    await redis.sadd(MODEL_ROLLED_BACK_KEY.format(model_name=model_service.model_name), version)
+    await redis.publish(MODEL_ROLLBACK_CHANNEL, version)
+    return {
+        "status": "success",
+        "rolled_back_version": version,
+        "active_version": model_service.model_version
+    }
+
+@app.get("/api/v1/admin/profile", dependencies=[Depends(require_admin)])
+async def profile_worker(request: Request, seconds: float = 10.0, interval_ms: float = 10.0):
+    """对当前worker采样分析N秒，返回折叠栈格式（可用flamegraph.pl/speedscope生成火焰图）
+
+    采样在后台线程进行，期间worker照常处理请求；同一worker同时只允许一个分析任务。
+    """
+    if not 0 < seconds <= settings.profile_max_seconds:
+        raise HTTPException(
+            status_code=400,
+            detail=f"seconds must be in (0, {settings.profile_max_seconds}]"
+        )
+    if getattr(request.app.state, 'profiling', False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    request.app.state.profiling = True
+    profiler = SamplingProfiler(interval=max(interval_ms, 1.0) / 1000)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+        request.app.state.profiling = False
+
+    logger.info(f"Profiled worker for {seconds}s, {profiler.sample_count} samples")
+    return PlainTextResponse(
+        profiler.collapsed(),
+        headers={"X-Profile-Samples": str(profiler.sample_count), "X-Profile-Pid": str(os.getpid())}
+    )
+
 @app.get("/api/v1/features/user/{user_id}")
 async def get_user_features_api(user_id: str, request: Request):
     """获取用户特征（调试用）"""
@@ -667,9 +2851,9 @@ async def get_user_features_api(user_id: str, request: Request):
 
 @app.get("/api/v1/features/item/{item_id}")
 async def get_item_features_api(item_id: str, request: Request):
-    """获取物品特征（调试用）"""
+    """获取物品特征（调试用，不返回内部使用的品类编码）"""
     features = await request.app.state.feature_service.get_item_features([item_id])
-    return features.get(item_id, {})
+    return {k: v for k, v in features.get(item_id, {}).items() if k != 'category_code'}
 
 # ============ 辅助函数 ============
 
@@ -679,63 +2863,46 @@ def generate_request_id() -> str:
     return str(uuid.uuid4())
 
 async def record_impressions(user_id: str, recommendations: List[RecommendationItem], request: Request):
-    """记录曝光"""
-    events = []
-    for i, rec in enumerate(recommendations):
-        events.append({
-            "user_id": user_id,
-            "item_id": rec.item_id,
-            "action": "impression",
-            "position": i,
-            "timestamp": datetime.now().timestamp()
-        })
+    """记录曝光（写入微批缓冲区，由ImpressionLogger批量发送到Kafka）"""
+    await request.app.state.impression_logger.log(user_id, recommendations)
 
-    # 异步发送到Kafka
-    await send_events_to_kafka(events)
-
-async def send_to_kafka(event: TrackEventRequest):
+async def send_to_kafka(producer: KafkaEventProducer, event: TrackEventRequest):
     """发送单个事件到Kafka"""
-    # 这里使用aiokafka实现
-    import aiokafka
-    producer = aiokafka.AIOKafkaProducer(
-        bootstrap_servers=settings.kafka_broker
-    )
-    await producer.start()
-    try:
-        value = json.dumps(event.dict()).encode()
-        await producer.send("user-events", value)
-    finally:
-        await producer.stop()
+    await producer.send(event.dict())
 
-async def send_events_to_kafka(events: List[Dict]):
+async def send_events_to_kafka(producer: KafkaEventProducer, events: List[Dict]):
     """批量发送事件到Kafka"""
-    import aiokafka
-    producer = aiokafka.AIOKafkaProducer(
-        bootstrap_servers=settings.kafka_broker
-    )
-    await producer.start()
-    try:
-        for event in events:
-            value = json.dumps(event).encode()
-            await producer.send("user-events", value)
-    finally:
-        await producer.stop()
+    await producer.send_batch(events)
 
-async def record_ab_test_event(event: TrackEventRequest):
-    """记录AB测试事件"""
-    # 存储到AB测试专用的Redis
-    ab_redis = await aioredis.from_url("redis://localhost:6380", decode_responses=True)
-
-    # 记录用户属于哪个实验组
+def ab_test_counter_key(event: TrackEventRequest) -> Optional[str]:
+    """事件对应的AB测试计数键，不参与AB统计的事件返回None"""
+    if not event.request_id:
+        return None
     if event.action == "impression":
-        key = f"ab:exposure:{event.request_id}"
-        await ab_redis.incr(key)
+        return f"ab:exposure:{event.request_id}"
     elif event.action == "click":
-        key = f"ab:click:{event.request_id}"
-        await ab_redis.incr(key)
+        return f"ab:click:{event.request_id}"
     elif event.action == "purchase":
-        key = f"ab:purchase:{event.request_id}"
-        await ab_redis.incr(key)
+        return f"ab:purchase:{event.request_id}"
+    return None
+
+def ab_test_flush_delay(event: TrackEventRequest) -> Optional[float]:
+    """事件的AB计数可接受的最长缓冲时间，None为使用默认的ab_flush_interval
+
+    购买（转化）计数用于实时查看实验效果，按ab_purchase_flush_delay尽快写入；
+    曝光和点击量大，使用默认间隔批量写入。
+    """
+    if event.action == "purchase":
+        return settings.ab_purchase_flush_delay
+    return None
+
+async def record_ab_test_event(ab_counters: ABCounterBuffer, event: TrackEventRequest,
+                               max_delay: Optional[float] = None):
+    """记录AB测试事件（计数经缓冲后批量写入AB测试专用的Redis）"""
+    # 记录用户属于哪个实验组
+    key = ab_test_counter_key(event)
+    if key is not None:
+        await ab_counters.incr(key, max_delay=max_delay)
 
 # ============ 启动 ============
 
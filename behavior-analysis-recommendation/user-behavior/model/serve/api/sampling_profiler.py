@@ -0,0 +1,70 @@
+"""
+采样式性能分析器
+后台线程按固定间隔读取所有线程的调用栈（sys._current_frames），
+聚合为折叠栈格式（每行 "帧1;帧2;...;帧N 次数"），可直接交给
+flamegraph.pl、speedscope等工具生成火焰图。不需要重启进程，也不依赖第三方库。
+"""
+
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+
+class SamplingProfiler:
+    """对当前进程做一段时间的采样"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, f"thread-{thread_id}"))
+            self.samples[";".join(reversed(stack))] += 1
+        self.sample_count += 1
+
+    def _run(self):
+        next_time = time.perf_counter()
+        while not self._stop.is_set():
+            self._sample()
+            next_time += self.interval
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                next_time = time.perf_counter()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def collapsed(self) -> str:
+        """折叠栈格式输出，按次数降序"""
+        return "\n".join(
+            f"{stack} {count}" for stack, count in self.samples.most_common()
+        ) + "\n"
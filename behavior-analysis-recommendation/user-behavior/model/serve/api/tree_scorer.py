@@ -0,0 +1,282 @@
+"""
+纯NumPy树集成打分器
+把XGBoost booster的所有树展平成连续数组，按层向量化遍历整个候选矩阵，
+线上不再需要xgboost及其DMatrix构建开销。
+
+离线编译并校验：
+    python tree_scorer.py ./models/xgboost/<version>
+会在版本目录下生成tree_ensemble.npz，并输出与predict_proba的一致性和耗时对比。
+"""
+
+import json
+import math
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# 输出经过sigmoid的目标函数，其余按原始margin输出
+SIGMOID_OBJECTIVES = {'binary:logistic', 'reg:logistic'}
+IDENTITY_OBJECTIVES = {'binary:logitraw', 'reg:squarederror', 'reg:linear', 'reg:absoluteerror'}
+# 补齐成完全二叉树后节点数随深度指数增长，过深的树（如lossguide）不编译
+MAX_COMPILED_DEPTH = 16
+
+
+def _parse_base_score(value) -> float:
+    """base_score在不同版本中可能是 "5E-1" 或 "[5E-1]" """
+    if isinstance(value, str):
+        value = value.strip().strip('[]')
+    return float(value)
+
+
+class CompiledTreeEnsemble:
+    """展平后的树集成
+
+    每棵树补齐成深度为max_depth的完全二叉树并按堆序存放，节点i的孩子为2i+1/2i+2，
+    遍历时只需按比较结果计算下标，不再查左右孩子数组。提前结束的叶子把输出值
+    复制到补齐出来的整棵子树，补齐节点上的分裂结果因此不影响最终得分。
+    """
+
+    def __init__(self, feature: np.ndarray, threshold: np.ndarray, default_left: np.ndarray,
+                 leaf_value: np.ndarray, max_depth: int, n_features: int,
+                 base_margin: float, objective: str):
+        self.feature = feature            # (树数 × 内部节点数)，展平
+        self.threshold = threshold
+        self.default_left = default_left
+        self.leaf_value = leaf_value      # (树数 × 叶子数)，展平
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+        self.base_margin = float(base_margin)
+        self.objective = objective
+        self.n_internal = 2 ** self.max_depth - 1
+        self.n_trees = len(leaf_value) // (self.n_internal + 1)
+        self._tree_offsets = (np.arange(self.n_trees) * self.n_internal).astype(np.int32)
+        self._leaf_offsets = (np.arange(self.n_trees) * (self.n_internal + 1)).astype(np.int32)
+
+    # ============ 编译 ============
+
+    @classmethod
+    def from_xgboost(cls, model: Any) -> 'CompiledTreeEnsemble':
+        """从XGBClassifier/XGBRegressor或Booster编译"""
+        booster = model.get_booster() if hasattr(model, 'get_booster') else model
+        raw = booster.save_raw(raw_format='json')
+        return cls.from_json(json.loads(bytes(raw).decode('utf-8')))
+
+    @classmethod
+    def from_json(cls, model_json: Dict) -> 'CompiledTreeEnsemble':
+        """从booster的JSON模型编译"""
+        learner = model_json['learner']
+        objective = learner['objective']['name']
+        if objective not in SIGMOID_OBJECTIVES and objective not in IDENTITY_OBJECTIVES:
+            raise ValueError(f"Unsupported objective: {objective}")
+
+        gradient_booster = learner['gradient_booster']
+        if gradient_booster.get('name') != 'gbtree':
+            raise ValueError(f"Unsupported booster: {gradient_booster.get('name')}")
+
+        model_param = learner['learner_model_param']
+        if int(model_param.get('num_class', 0)) > 1:
+            raise ValueError("Multi-class models are not supported")
+
+        trees = gradient_booster['model']['trees']
+        # 与predict_proba一致：训练时用了早停则只取最佳轮次之前的树
+        best_iteration = learner.get('attributes', {}).get('best_iteration')
+        if best_iteration is not None:
+            num_parallel_tree = int(
+                gradient_booster['model']['gbtree_model_param'].get('num_parallel_tree', 1)
+            )
+            trees = trees[:(int(best_iteration) + 1) * num_parallel_tree]
+        if not trees:
+            raise ValueError("Model has no trees")
+
+        base_score = _parse_base_score(model_param['base_score'])
+        if objective in SIGMOID_OBJECTIVES:
+            base_margin = math.log(base_score / (1.0 - base_score))
+        else:
+            base_margin = base_score
+
+        for tree in trees:
+            if any(int(t) != 0 for t in tree.get('split_type', [])):
+                raise ValueError("Categorical splits are not supported")
+
+        max_depth = max(1, max(cls._tree_depth(tree['left_children'], tree['right_children'])
+                               for tree in trees))
+        if max_depth > MAX_COMPILED_DEPTH:
+            raise ValueError(f"Tree depth {max_depth} exceeds {MAX_COMPILED_DEPTH}")
+
+        n_internal = 2 ** max_depth - 1
+        n_leaves = n_internal + 1
+        feature = np.zeros((len(trees), n_internal), dtype=np.int32)
+        threshold = np.zeros((len(trees), n_internal), dtype=np.float32)
+        default_left = np.ones((len(trees), n_internal), dtype=bool)
+        leaf_value = np.zeros((len(trees), n_leaves), dtype=np.float32)
+
+        for t, tree in enumerate(trees):
+            left = tree['left_children']
+            right = tree['right_children']
+            # JSON模型中叶子的输出值存放在split_conditions里
+            conditions = np.asarray(tree['split_conditions'], dtype=np.float32)
+            stack = [(0, 0, 0)]  # (原节点, 堆序槽位, 深度)
+            while stack:
+                node, slot, depth = stack.pop()
+                if left[node] == -1:
+                    span = 2 ** (max_depth - depth)
+                    first = (slot + 1) * span - 1 - n_internal
+                    leaf_value[t, first:first + span] = conditions[node]
+                    continue
+                feature[t, slot] = tree['split_indices'][node]
+                threshold[t, slot] = conditions[node]
+                default_left[t, slot] = bool(tree['default_left'][node])
+                stack.append((left[node], 2 * slot + 1, depth + 1))
+                stack.append((right[node], 2 * slot + 2, depth + 1))
+
+        return cls(
+            feature=feature.ravel(),
+            threshold=threshold.ravel(),
+            default_left=default_left.ravel(),
+            leaf_value=leaf_value.ravel(),
+            max_depth=max_depth,
+            n_features=int(model_param['num_feature']),
+            base_margin=base_margin,
+            objective=objective
+        )
+
+    @staticmethod
+    def _tree_depth(left: List[int], right: List[int]) -> int:
+        depth = 0
+        level = [0]
+        while True:
+            children = [c for node in level for c in (left[node], right[node]) if c != -1]
+            if not children:
+                return depth
+            depth += 1
+            level = children
+
+    # ============ 持久化 ============
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            feature=self.feature, threshold=self.threshold,
+            default_left=self.default_left, leaf_value=self.leaf_value,
+            meta=np.array(json.dumps({
+                'max_depth': self.max_depth,
+                'n_features': self.n_features,
+                'base_margin': self.base_margin,
+                'objective': self.objective,
+            }))
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'CompiledTreeEnsemble':
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            return cls(
+                feature=data['feature'], threshold=data['threshold'],
+                default_left=data['default_left'], leaf_value=data['leaf_value'],
+                **meta
+            )
+
+    # ============ 推理 ============
+
+    def predict_margin(self, X: np.ndarray) -> np.ndarray:
+        """按层遍历：每一层对 (样本数 × 树数) 的当前节点统一做一次比较和跳转"""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_rows = X.shape[0]
+        if X.shape[1] != self.n_features:
+            raise ValueError(f"Expected {self.n_features} features, got {X.shape[1]}")
+        if n_rows == 0:
+            return np.empty(0, dtype=np.float64)
+
+        flat = X.ravel()
+        row_offsets = (np.arange(n_rows, dtype=np.int32) * self.n_features)[:, None]
+        has_missing = bool(np.isnan(flat).any())
+
+        slots = np.zeros((n_rows, self.n_trees), dtype=np.int32)
+        for _ in range(self.max_depth):
+            nodes = slots + self._tree_offsets
+            x = flat.take(row_offsets + self.feature.take(nodes))
+            # XGBoost的分裂规则：x < threshold 走左子树，缺失值走默认方向
+            go_right = x >= self.threshold.take(nodes)
+            if has_missing:
+                go_right = np.where(np.isnan(x), ~self.default_left.take(nodes), go_right)
+            slots = 2 * slots + 1 + go_right
+
+        leaves = slots - self.n_internal + self._leaf_offsets
+        return self.leaf_value.take(leaves).sum(axis=1, dtype=np.float64) + self.base_margin
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        margin = self.predict_margin(X)
+        if self.objective in SIGMOID_OBJECTIVES:
+            return 1.0 / (1.0 + np.exp(-margin))
+        return margin
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """与XGBClassifier.predict_proba相同的 (n, 2) 输出"""
+        if self.objective not in SIGMOID_OBJECTIVES:
+            raise AttributeError("predict_proba is only available for logistic objectives")
+        positive = self.predict(X)
+        return np.column_stack([1.0 - positive, positive])
+
+
+def check_parity(compiled: CompiledTreeEnsemble, model: Any, X: np.ndarray,
+                 atol: float = 1e-5) -> float:
+    """与原生模型比较输出，返回最大绝对误差，超过atol时抛出ValueError"""
+    if hasattr(model, 'predict_proba'):
+        expected = model.predict_proba(X)[:, 1]
+        actual = compiled.predict_proba(X)[:, 1]
+    else:
+        expected = np.asarray(model.predict(X)).reshape(-1)
+        actual = compiled.predict(X)
+    max_error = float(np.max(np.abs(expected - actual))) if len(X) else 0.0
+    if max_error > atol:
+        raise ValueError(f"Compiled scorer deviates from native model by {max_error:.3g}")
+    return max_error
+
+
+def parity_matrix(n_rows: int, n_features: int, seed: int = 0,
+                  missing_rate: float = 0.05) -> np.ndarray:
+    """随机校验矩阵，包含一定比例的缺失值以覆盖默认方向"""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, n_features)).astype(np.float32)
+    X[rng.random(X.shape) < missing_rate] = np.nan
+    return X
+
+
+def benchmark_ms(fn, X: np.ndarray, repeat: int = 20) -> float:
+    """单次调用的平均耗时（毫秒），先调用一次预热"""
+    fn(X)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(X)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main(argv: Optional[List[str]] = None):
+    """编译版本目录下的model.pkl为tree_ensemble.npz，并校验一致性、对比耗时"""
+    import joblib
+
+    argv = argv if argv is not None else sys.argv[1:]
+    if not argv:
+        print("usage: python tree_scorer.py <model_version_dir> [batch_size]")
+        sys.exit(1)
+    version_dir = argv[0].rstrip('/')
+    batch_size = int(argv[1]) if len(argv) > 1 else 200
+
+    model = joblib.load(f"{version_dir}/model.pkl")
+    compiled = CompiledTreeEnsemble.from_xgboost(model)
+
+    X = parity_matrix(max(batch_size, 1000), compiled.n_features)
+    max_error = check_parity(compiled, model, X)
+    compiled.save(f"{version_dir}/tree_ensemble.npz")
+
+    batch = X[:batch_size]
+    native_ms = benchmark_ms(model.predict_proba, batch, repeat=50)
+    compiled_ms = benchmark_ms(compiled.predict_proba, batch, repeat=50)
+    print(f"trees={compiled.n_trees} max_depth={compiled.max_depth} max_abs_error={max_error:.3g}")
+    print(f"batch={batch_size} native={native_ms:.3f}ms compiled={compiled_ms:.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
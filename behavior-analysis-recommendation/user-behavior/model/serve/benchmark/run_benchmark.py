@@ -0,0 +1,498 @@
+"""
+推荐API压测与基准
+在进程内启动api/main.py的FastAPI应用，外部依赖替换为本地替身（见standins.py）：
+fakeredis、按ID生成特征的Feast替身、只计数的Kafka生产者、合成XGBoost模型。
+请求通过httpx的ASGI传输直接进入应用，不经过网络和uvicorn，因此结果反映的是
+应用自身的开销，适合在同一台机器上做前后对比，不代表线上绝对延迟。
+
+流量构成可配置：缓存命中比例、页面类型、每个请求的候选数、事件上报占比，
+以及批量推荐和批量事件接口的占比和每批大小。
+输出每个接口的吞吐和p50/p95/p99，以及各处理阶段（来自recommendation_stage_latency
+直方图，精度受分桶限制）的分位数。
+
+    pip install -r requirements.txt
+    python run_benchmark.py --requests 5000 --concurrency 32 --output result.json
+
+保存基线并在之后对比（任一接口p95/p99变慢或吞吐下降超过容忍度时退出码为1）：
+
+    python run_benchmark.py --save-baseline baseline.json
+    python run_benchmark.py --baseline baseline.json --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'api'))
+sys.path.insert(0, HERE)
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from standins import (  # noqa: E402
+    CandidatePlan, FakeRedisFactory, NullKafkaProducer, StubFeatureStore,
+    build_synthetic_model, seed_redis,
+)
+
+EVENT_ACTIONS = ['impression', 'click', 'add_to_cart', 'purchase']
+ENDPOINT_PATHS = {
+    'recommend:hot': '/api/v1/recommend',
+    'recommend:cold': '/api/v1/recommend',
+    'recommend_batch': '/api/v1/recommend/batch',
+    'events': '/api/v1/events',
+    'events_batch': '/api/v1/events/batch',
+}
+COMPARED_METRICS = ('p95_ms', 'p99_ms')
+
+
+# ============ 流量计划 ============
+
+def build_plan(args, n_requests: int, rng: random.Random, cold_offset: int) -> List[Tuple[str, Any]]:
+    """生成 (接口, 请求体) 列表
+
+    命中缓存的请求从预热过的热门用户中抽取；未命中的请求每次使用新的用户，
+    保证一定走完整的召回-特征-打分流程。批量接口的每个元素按同样的规则生成。
+    """
+    plan = []
+    cold = [cold_offset]
+
+    def recommend_body() -> Tuple[bool, Dict]:
+        page_type = rng.choice(args.page_types)
+        hit = rng.random() < args.cache_hit_ratio
+        if hit:
+            user_id = f"user_{rng.randrange(args.hot_users)}"
+        else:
+            user_id = f"user_{cold[0]}"
+            cold[0] += 1
+        return hit, {
+            'user_id': user_id,
+            'page_type': page_type,
+            'num_recommendations': args.num_recommendations,
+        }
+
+    def event_body() -> Dict:
+        body = {
+            'user_id': f"user_{rng.randrange(args.hot_users)}",
+            'item_id': f"pop_{rng.choice(args.page_types)}_{rng.randrange(100)}",
+            'action': rng.choice(EVENT_ACTIONS),
+            'position': rng.randrange(args.num_recommendations),
+        }
+        if rng.random() < 0.5:
+            body['request_id'] = f"req_{rng.randrange(10 ** 6)}"
+        return body
+
+    for _ in range(n_requests):
+        draw = rng.random()
+        if draw < args.event_share:
+            plan.append(('events', event_body()))
+            continue
+        draw -= args.event_share
+        if draw < args.events_batch_share:
+            plan.append(('events_batch', [event_body() for _ in range(args.events_batch_size)]))
+            continue
+        draw -= args.events_batch_share
+        if draw < args.recommend_batch_share:
+            plan.append(('recommend_batch',
+                         [recommend_body()[1] for _ in range(args.recommend_batch_size)]))
+            continue
+
+        hit, body = recommend_body()
+        plan.append(('recommend:hot' if hit else 'recommend:cold', body))
+    return plan
+
+
+def count_cold(plan: List[Tuple[str, Any]], hot_users: int) -> int:
+    """计划中使用的新用户数（热门用户为user_0 ~ user_{hot_users-1}）"""
+    users = set()
+    for endpoint, body in plan:
+        for item in (body if endpoint == 'recommend_batch' else [body]):
+            if endpoint.startswith('recommend') and int(item['user_id'].split('_')[1]) >= hot_users:
+                users.add(item['user_id'])
+    return len(users)
+
+
+# ============ 统计 ============
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    """客户端侧的延迟分位数（毫秒）与吞吐"""
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+    values = np.asarray(latencies) * 1000
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'throughput_rps': round(len(values) / elapsed, 1) if elapsed > 0 else None,
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'max_ms': round(float(values.max()), 3),
+    }
+
+
+def histogram_buckets(histogram, label: str) -> Dict[str, Dict]:
+    """读取带单个标签的Histogram，返回 标签值 -> {'buckets': [(上界, 累计数)], 'count', 'sum'}"""
+    result: Dict[str, Dict] = defaultdict(lambda: {'buckets': [], 'count': 0.0, 'sum': 0.0})
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            key = sample.labels.get(label)
+            if key is None:
+                continue
+            if sample.name.endswith('_bucket'):
+                result[key]['buckets'].append((float(sample.labels['le']), sample.value))
+            elif sample.name.endswith('_count'):
+                result[key]['count'] = sample.value
+            elif sample.name.endswith('_sum'):
+                result[key]['sum'] = sample.value
+    return dict(result)
+
+
+def bucket_quantile(q: float, buckets: List[Tuple[float, float]]) -> Optional[float]:
+    """与PromQL histogram_quantile相同的桶内线性插值"""
+    buckets = sorted(buckets)
+    total = buckets[-1][1] if buckets else 0
+    if total <= 0:
+        return None
+    rank = q * total
+    lower, lower_count = 0.0, 0.0
+    for upper, count in buckets:
+        if count >= rank:
+            if upper == float('inf'):
+                return lower
+            if count == lower_count:
+                return upper
+            return lower + (upper - lower) * (rank - lower_count) / (count - lower_count)
+        lower, lower_count = upper, count
+    return lower
+
+
+def histogram_delta(before: Dict[str, Dict], after: Dict[str, Dict]) -> Dict[str, Dict]:
+    """测量阶段内的各阶段分位数（毫秒）"""
+    stages = {}
+    for key, current in sorted(after.items()):
+        previous = before.get(key, {'buckets': [], 'count': 0.0, 'sum': 0.0})
+        base = dict(previous['buckets'])
+        buckets = [(upper, count - base.get(upper, 0.0)) for upper, count in current['buckets']]
+        count = current['count'] - previous['count']
+        if count <= 0:
+            continue
+        stages[key] = {
+            'count': int(count),
+            'mean_ms': round((current['sum'] - previous['sum']) / count * 1000, 3),
+        }
+        for q, name in ((0.5, 'p50_ms'), (0.95, 'p95_ms'), (0.99, 'p99_ms')):
+            value = bucket_quantile(q, buckets)
+            stages[key][name] = round(value * 1000, 3) if value is not None else None
+    return stages
+
+
+# ============ 执行 ============
+
+def response_ok(endpoint: str, body: Any, response: httpx.Response) -> bool:
+    """接口返回200且没有部分失败（批量推荐每个用户一行，批量事件没有被拒绝的事件）"""
+    if response.status_code != 200:
+        return False
+    if endpoint == 'events':
+        return response.json().get('status') == 'success'
+    if endpoint == 'events_batch':
+        result = response.json()
+        return result.get('status') == 'success' and not result.get('rejected')
+    if endpoint == 'recommend_batch':
+        lines = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+        return len(lines) == len(body) and all('recommendations' in line for line in lines)
+    return True
+
+
+async def drive(client: httpx.AsyncClient, plan: List[Tuple[str, Any]], concurrency: int,
+                deadline_ms: Optional[float] = None):
+    """以固定并发发送请求，返回 (接口 -> 延迟列表, 接口 -> 错误数, 总耗时)"""
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    queue = iter(plan)
+    headers = {'X-Request-Deadline-Ms': str(deadline_ms)} if deadline_ms else {}
+
+    async def worker():
+        for endpoint, body in queue:
+            start = time.perf_counter()
+            try:
+                response = await client.post(ENDPOINT_PATHS[endpoint], json=body, headers=headers)
+                ok = response_ok(endpoint, body, response)
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            if ok:
+                latencies[endpoint].append(elapsed)
+            else:
+                errors[endpoint] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+
+async def wait_for_embedding_index(app, timeout: float = 60.0):
+    index = app.state.embedding_index
+    deadline = time.monotonic() + timeout
+    while not len(index):
+        if time.monotonic() > deadline:
+            raise RuntimeError("Embedding index was not built in time")
+        await asyncio.sleep(0.05)
+
+
+async def run(args) -> Dict:
+    rng = random.Random(args.seed)
+    candidate_plan = CandidatePlan(args.candidates)
+
+    measured = build_plan(args, args.requests, rng, cold_offset=args.hot_users)
+    measured_cold = count_cold(measured, args.hot_users)
+    warmup = build_plan(args, args.warmup, rng, cold_offset=args.hot_users + measured_cold)
+    n_users = args.hot_users + measured_cold + count_cold(warmup, args.hot_users)
+
+    redis_factory = FakeRedisFactory()
+    main.aioredis.from_url = redis_factory.from_url
+    main.FeatureStore = StubFeatureStore
+    main.AIOKafkaProducer = NullKafkaProducer
+    StubFeatureStore.latency_ms = args.feast_latency_ms
+
+    model_dir = tempfile.mkdtemp(prefix='rec-benchmark-')
+    build_synthetic_model(model_dir, n_estimators=args.model_trees, max_depth=args.model_depth,
+                          seed=args.seed)
+
+    main.settings.model_path = model_dir
+    main.settings.model_name = 'xgboost'
+    main.settings.model_version = 'latest'
+    main.settings.model_watch_interval = 0
+    main.settings.model_scorer = args.scorer
+    main.settings.item_snapshot_path = None
+    main.settings.embedding_recall_size = candidate_plan.embedding
+    main.settings.embedding_index_rebuild_interval = 0
+    main.settings.request_deadline_ms = 0
+    main.settings.local_cache_ttl = 3600  # 运行期间热门用户的缓存不过期
+
+    seed_client = redis_factory.client(main.settings.redis_url, decode_responses=True)
+    await seed_redis(seed_client, candidate_plan, args.page_types, n_users, seed=args.seed)
+
+    app = main.app
+    async with app.router.lifespan_context(app):
+        if candidate_plan.embedding:
+            await wait_for_embedding_index(app)
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            # 预热热门用户的推荐缓存，保证命中比例符合配置
+            hot = [('recommend:hot', {'user_id': f"user_{u}", 'page_type': page_type,
+                                      'num_recommendations': args.num_recommendations})
+                   for u in range(args.hot_users) for page_type in args.page_types]
+            await drive(client, hot, args.concurrency)
+            await drive(client, warmup, args.concurrency, args.deadline_ms)
+
+            stages_before = histogram_buckets(main.recommendation_stage_latency, 'stage')
+            routes_before = histogram_buckets(main.recall_route_latency, 'route')
+            latencies, errors, elapsed = await drive(client, measured, args.concurrency,
+                                                     args.deadline_ms)
+            stages_after = histogram_buckets(main.recommendation_stage_latency, 'stage')
+            routes_after = histogram_buckets(main.recall_route_latency, 'route')
+
+    endpoints = {
+        endpoint: summarize(latencies[endpoint], errors[endpoint], elapsed)
+        for endpoint in sorted(set(latencies) | set(errors))
+    }
+    recommend = latencies['recommend:hot'] + latencies['recommend:cold']
+    endpoints['recommend'] = summarize(
+        recommend, errors['recommend:hot'] + errors['recommend:cold'], elapsed
+    )
+    total_errors = sum(errors.values())
+
+    return {
+        'config': {
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'cache_hit_ratio': args.cache_hit_ratio,
+            'page_types': args.page_types,
+            'candidates': args.candidates,
+            'candidate_plan': candidate_plan.to_dict(),
+            'event_share': args.event_share,
+            'events_batch_share': args.events_batch_share,
+            'events_batch_size': args.events_batch_size,
+            'recommend_batch_share': args.recommend_batch_share,
+            'recommend_batch_size': args.recommend_batch_size,
+            'hot_users': args.hot_users,
+            'num_recommendations': args.num_recommendations,
+            'feast_latency_ms': args.feast_latency_ms,
+            'scorer': args.scorer,
+            'active_scorer': type(app.state.model_service.model).__name__,
+            'model_trees': args.model_trees,
+            'model_depth': args.model_depth,
+            'deadline_ms': args.deadline_ms,
+            'seed': args.seed,
+        },
+        'environment': environment(),
+        'summary': {
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round((sum(len(v) for v in latencies.values()) + total_errors) / elapsed, 1),
+            'errors': total_errors,
+        },
+        'endpoints': endpoints,
+        'stages': histogram_delta(stages_before, stages_after),
+        'recall_routes': histogram_delta(routes_before, routes_after),
+    }
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+            text=True, timeout=10
+        ).stdout.strip() or None
+    except Exception:
+        commit = None
+    import xgboost
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'xgboost': xgboost.__version__,
+        'git_commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+# ============ 基线对比 ============
+
+def compare(result: Dict, baseline: Dict, tolerance: float, min_delta_ms: float = 1.0) -> List[str]:
+    """返回超出容忍度的退化项
+
+    只比较接口级指标，阶段分位数受分桶精度限制不参与判定；
+    延迟的绝对变化小于min_delta_ms时视为噪声（缓存命中等亚毫秒路径的相对波动很大）。
+    """
+    regressions = []
+    for endpoint, base in baseline.get('endpoints', {}).items():
+        current = result['endpoints'].get(endpoint)
+        if not current or not base.get('requests'):
+            continue
+        for metric in COMPARED_METRICS:
+            if base.get(metric) and current.get(metric) is not None \
+                    and current[metric] > base[metric] * (1 + tolerance) \
+                    and current[metric] - base[metric] >= min_delta_ms:
+                regressions.append(
+                    f"{endpoint} {metric}: {base[metric]:.3f} -> {current[metric]:.3f}"
+                )
+        if base.get('throughput_rps') and current.get('throughput_rps') is not None \
+                and current['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append(
+                f"{endpoint} throughput_rps: {base['throughput_rps']:.1f} -> {current['throughput_rps']:.1f}"
+            )
+        if current.get('errors', 0) > base.get('errors', 0):
+            regressions.append(f"{endpoint} errors: {base.get('errors', 0)} -> {current['errors']}")
+    return regressions
+
+
+def print_report(result: Dict):
+    summary = result['summary']
+    print(f"elapsed={summary['elapsed_s']}s throughput={summary['throughput_rps']} req/s "
+          f"errors={summary['errors']}")
+    header = f"{'':<18}{'requests':>9}{'errors':>8}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}"
+    print("\nendpoint (ms)\n" + header)
+    for name, stats in result['endpoints'].items():
+        if not stats.get('requests'):
+            print(f"{name:<18}{0:>9}{stats['errors']:>8}")
+            continue
+        print(f"{name:<18}{stats['requests']:>9}{stats['errors']:>8}{stats['throughput_rps']:>10}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    for title, section in (('stage', result['stages']), ('recall route', result['recall_routes'])):
+        print(f"\n{title} (ms, from histogram buckets)")
+        print(f"{'':<18}{'count':>9}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for name, stats in section.items():
+            print(f"{name:<18}{stats['count']:>9}{stats['mean_ms']:>10}"
+                  f"{str(stats['p50_ms']):>10}{str(stats['p95_ms']):>10}{str(stats['p99_ms']):>10}")
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Recommendation API load test and benchmark")
+    parser.add_argument('--requests', type=int, default=2000, help="测量阶段的请求数")
+    parser.add_argument('--warmup', type=int, default=200, help="不计入结果的预热请求数")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--cache-hit-ratio', type=float, default=0.5,
+                        help="推荐请求中命中推荐缓存的比例")
+    parser.add_argument('--page-types', default='home,product_detail,cart,search',
+                        help="逗号分隔，均匀抽取")
+    parser.add_argument('--candidates', type=int, default=150,
+                        help="每个未命中缓存的请求的召回候选数（最多200）")
+    parser.add_argument('--event-share', type=float, default=0.3,
+                        help="请求中事件上报（/api/v1/events）的比例")
+    parser.add_argument('--events-batch-share', type=float, default=0.05,
+                        help="请求中批量事件上报（/api/v1/events/batch）的比例")
+    parser.add_argument('--events-batch-size', type=int, default=100)
+    parser.add_argument('--recommend-batch-share', type=float, default=0.02,
+                        help="请求中批量推荐（/api/v1/recommend/batch）的比例")
+    parser.add_argument('--recommend-batch-size', type=int, default=100)
+    parser.add_argument('--hot-users', type=int, default=200, help="命中缓存的用户池大小")
+    parser.add_argument('--num-recommendations', type=int, default=20)
+    parser.add_argument('--feast-latency-ms', type=float, default=1.0,
+                        help="Feast替身每次在线读取的模拟耗时")
+    parser.add_argument('--scorer', default='auto', choices=['auto', 'native', 'compiled'])
+    parser.add_argument('--model-trees', type=int, default=100)
+    parser.add_argument('--model-depth', type=int, default=6)
+    parser.add_argument('--deadline-ms', type=float, default=None,
+                        help="通过X-Request-Deadline-Ms设置的延迟预算")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="结果JSON的保存路径")
+    parser.add_argument('--save-baseline', help="将结果保存为基线")
+    parser.add_argument('--baseline', help="与该基线对比，退化时退出码为1")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="允许的相对退化幅度")
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help="延迟退化的最小绝对幅度，低于该值不计为退化")
+    args = parser.parse_args(argv)
+    args.page_types = [p for p in args.page_types.split(',') if p]
+    return args
+
+
+def main_cli(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    result = asyncio.run(run(args))
+    print_report(result)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(result, f, indent=2, ensure_ascii=False)
+            print(f"\nWrote {path}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('config', {}).get('requests') is not None:
+            ignored = ('requests', 'warmup', 'active_scorer')
+            differs = [key for key, value in baseline['config'].items()
+                       if key not in ignored and result['config'].get(key) != value]
+            if differs:
+                print(f"\nWarning: config differs from baseline: {', '.join(differs)}")
+        regressions = compare(result, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"\nRegressions beyond {args.tolerance:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main_cli()
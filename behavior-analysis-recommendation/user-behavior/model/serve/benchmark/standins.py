@@ -0,0 +1,240 @@
+"""
+基准测试用的本地替身
+- 内存Redis：fakeredis，按URL区分实例
+- Feast在线存储：按ID确定性生成特征，可配置读取延迟
+- Kafka生产者：只计数不发送
+- 合成XGBoost模型：按API的特征名训练的小模型
+
+这些替身只在基准测试进程中替换main模块的依赖，不影响服务本身。
+"""
+
+import json
+import math
+import os
+import time
+import zlib
+from typing import Dict, List
+
+import numpy as np
+
+
+# ============ Redis ============
+
+
+class FakeRedisFactory:
+    """替换aioredis.from_url，同一URL共享同一个内存实例"""
+
+    def __init__(self):
+        import fakeredis
+        self._fakeredis = fakeredis
+        self._servers: Dict[str, object] = {}
+
+    def server(self, url: str):
+        if url not in self._servers:
+            self._servers[url] = self._fakeredis.FakeServer()
+        return self._servers[url]
+
+    def client(self, url: str, decode_responses: bool = False):
+        import fakeredis.aioredis
+        return fakeredis.aioredis.FakeRedis(server=self.server(url), decode_responses=decode_responses)
+
+    def from_url(self, url: str, decode_responses: bool = False, **kwargs):
+        return self.client(url, decode_responses=decode_responses)
+
+
+# ============ Feast ============
+
+
+def _stable_fraction(key: str) -> float:
+    """由字符串确定性地得到 [0, 1) 的数"""
+    return (zlib.crc32(key.encode('utf-8')) & 0xFFFFFFFF) / 2 ** 32
+
+
+class _OnlineResponse:
+    def __init__(self, data: Dict[str, List]):
+        self._data = data
+
+    def to_dict(self) -> Dict[str, List]:
+        return self._data
+
+
+class StubFeatureStore:
+    """Feast FeatureStore的替身，get_online_features按实体ID生成确定性的特征值"""
+
+    latency_ms: float = 0.0  # 模拟在线存储的读取耗时，由基准脚本设置
+    calls: int = 0
+
+    def __init__(self, repo_path: str = None, **kwargs):
+        self.repo_path = repo_path
+
+    def get_online_features(self, features: List[str], entity_rows: List[Dict]) -> _OnlineResponse:
+        StubFeatureStore.calls += 1
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000)
+
+        entity_key = next(iter(entity_rows[0])) if entity_rows else 'id'
+        ids = [str(row[entity_key]) for row in entity_rows]
+        data: Dict[str, List] = {entity_key: ids}
+        for ref in features:
+            name = ref.split(':', 1)[1]
+            if name == 'recent_items':
+                data[name] = [[] for _ in ids]
+            elif name == 'user_segment':
+                data[name] = [f"segment_{int(_stable_fraction(i) * 5)}" for i in ids]
+            else:
+                data[name] = [round(_stable_fraction(f"{i}:{name}") * 100, 3) for i in ids]
+        return _OnlineResponse(data)
+
+
+# ============ Kafka ============
+
+
+class _NullBatch:
+    def __init__(self):
+        self.count = 0
+
+    def append(self, key=None, value=None, timestamp=None):
+        self.count += 1
+        return object()
+
+    def record_count(self) -> int:
+        return self.count
+
+
+class NullKafkaProducer:
+    """AIOKafkaProducer的替身，消息立即确认"""
+
+    sent: int = 0
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    @staticmethod
+    def _delivered():
+        import asyncio
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    async def send(self, topic, value=None, key=None, **kwargs):
+        NullKafkaProducer.sent += 1
+        return self._delivered()
+
+    async def partitions_for(self, topic):
+        return {0}
+
+    def create_batch(self):
+        return _NullBatch()
+
+    async def send_batch(self, batch, topic, partition=None):
+        NullKafkaProducer.sent += batch.record_count()
+        return self._delivered()
+
+
+# ============ 模型 ============
+
+
+MODEL_FEATURE_NAMES = [
+    'avg_dwell_time', 'click_count_5min', 'click_7d_avg', 'purchase_30d_total',
+    'total_clicks', 'total_purchases', 'purchase_rate', 'popularity_score',
+]
+
+
+def build_synthetic_model(model_path: str, n_estimators: int = 100, max_depth: int = 6,
+                          seed: int = 42) -> str:
+    """训练一个合成XGBoost模型并按ModelManager的目录结构保存，返回版本目录"""
+    import joblib
+    import xgboost as xgb
+
+    rng = np.random.default_rng(seed)
+    X = rng.random((5000, len(MODEL_FEATURE_NAMES))).astype(np.float32) * 100
+    logits = (X[:, 7] - 50) / 10 + (X[:, 4] - 50) / 20 + rng.normal(size=len(X))
+    y = (logits > 0).astype(int)
+
+    model = xgb.XGBClassifier(
+        n_estimators=n_estimators, max_depth=max_depth, learning_rate=0.1,
+        random_state=seed, n_jobs=1
+    )
+    model.fit(X, y)
+
+    version_dir = os.path.join(model_path, 'xgboost', 'v1')
+    os.makedirs(version_dir, exist_ok=True)
+    joblib.dump(model, os.path.join(version_dir, 'model.pkl'))
+    with open(os.path.join(version_dir, 'feature_names.json'), 'w') as f:
+        json.dump(MODEL_FEATURE_NAMES, f)
+    open(os.path.join(version_dir, '_SUCCESS'), 'w').close()
+    return version_dir
+
+
+# ============ 召回数据 ============
+
+
+class CandidatePlan:
+    """按目标候选数分配各路召回的规模
+
+    热门召回最多100个；其余由最近交互物品的相似列表（每个物品最多10个）补足；
+    仍不够的部分交给向量召回。各路物品ID互不重叠，候选数因此是确定的。
+    """
+
+    RECENT_ITEMS_PER_USER = 6
+    SIMILAR_PER_ITEM = 10
+    POPULAR_MAX = 100
+
+    def __init__(self, candidates: int):
+        candidates = max(1, min(candidates, 200))
+        self.popular = min(candidates, self.POPULAR_MAX)
+        rest = candidates - self.popular
+        self.similar_per_item = min(self.SIMILAR_PER_ITEM,
+                                    math.ceil(rest / self.RECENT_ITEMS_PER_USER)) if rest else 0
+        rest -= self.similar_per_item * self.RECENT_ITEMS_PER_USER
+        self.embedding = max(0, rest)
+
+    def to_dict(self) -> Dict[str, int]:
+        return {
+            'popular': self.popular,
+            'similar_per_item': self.similar_per_item,
+            'embedding': self.embedding,
+        }
+
+
+async def seed_redis(redis, plan: CandidatePlan, page_types: List[str], n_users: int,
+                     recent_pool: int = 50, embedding_pool: int = 5000, dim: int = 32,
+                     seed: int = 0):
+    """写入召回所需的Redis数据：热门榜、用户最近交互、相似物品、物品向量"""
+    rng = np.random.default_rng(seed)
+    pipe = redis.pipeline(transaction=False)
+
+    for page_type in page_types:
+        key = f"popular:{page_type}"
+        pipe.zadd(key, {f"pop_{page_type}_{j}": plan.popular - j for j in range(plan.popular)})
+
+    recent_items = [f"recent_{r}" for r in range(recent_pool)]
+    if plan.similar_per_item:
+        for item_id in recent_items:
+            pipe.zadd(f"item:{item_id}:similar", {
+                f"sim_{item_id}_{j}": plan.similar_per_item - j for j in range(plan.similar_per_item)
+            })
+
+    for u in range(n_users):
+        picks = rng.choice(recent_pool, CandidatePlan.RECENT_ITEMS_PER_USER, replace=False)
+        pipe.rpush(f"user:user_{u}:realtime:recent_items", *[recent_items[p] for p in picks])
+    await pipe.execute()
+
+    if plan.embedding:
+        # 最近交互物品与向量池一起建索引，用户向量由最近交互物品的向量得到
+        vectors = rng.normal(size=(recent_pool + embedding_pool, dim)).astype(np.float32)
+        ids = recent_items + [f"emb_{j}" for j in range(embedding_pool)]
+        for start in range(0, len(ids), 1000):
+            await redis.mset({
+                f"item:{item_id}:embedding": json.dumps(vector.round(4).tolist())
+                for item_id, vector in zip(ids[start:start + 1000], vectors[start:start + 1000])
+            })
@@ -0,0 +1,92 @@
+"""
+API接口测试（不启动lifespan，依赖的服务按需放入app.state）
+
+    cd model/serve && python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+for _module in ('fastapi', 'aioredis', 'aiokafka', 'feast'):
+    pytest.importorskip(_module)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+
+
+class RecordingProducer:
+    """记录批量写入的事件"""
+
+    def __init__(self):
+        self.batches = []
+
+    async def send(self, event):
+        self.batches.append([event])
+
+    async def send_batch(self, events):
+        self.batches.append(list(events))
+
+
+class RecordingABCounters:
+    """记录AB计数及调用方要求的最长延迟"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def incr(self, key, amount=1, max_delay=None):
+        self.calls.append((key, amount, max_delay))
+
+
+@pytest.fixture
+def client():
+    main.app.state.event_producer = RecordingProducer()
+    main.app.state.ab_counters = RecordingABCounters()
+    return TestClient(main.app)
+
+
+def test_events_batch_ndjson_rejects_by_line_number(client):
+    body = (
+        b'{"user_id": "u1", "item_id": "a", "action": "click"}\n'
+        b'\n'
+        b'{"user_id": "u1", "item_id": "b", "action": \n'
+        b'{"user_id": "u1", "action": "click"}\n'
+        b'\n'
+        b'{"user_id": "u1", "item_id": "c", "action": "impression"}\n'
+    )
+    response = client.post('/api/v1/events/batch', content=body,
+                           headers={'Content-Type': 'application/x-ndjson'})
+
+    result = response.json()
+    assert response.status_code == 200
+    assert result['status'] == 'success'
+    assert result['accepted'] == 2
+    assert [rejected['index'] for rejected in result['rejected']] == [2, 3]
+    assert result['rejected'][0]['error'].startswith('Invalid JSON')
+    sent = main.app.state.event_producer.batches[0]
+    assert [event['item_id'] for event in sent] == ['a', 'c']
+
+
+def test_events_batch_json_array_rejects_by_position(client):
+    response = client.post('/api/v1/events/batch', json=[
+        {'user_id': 'u1', 'item_id': 'a', 'action': 'click'},
+        {'user_id': 'u1'},
+        5,
+    ])
+
+    result = response.json()
+    assert result['accepted'] == 1
+    assert [rejected['index'] for rejected in result['rejected']] == [1, 2]
+
+
+def test_metrics_content_type_is_exact(client):
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.headers['content-type'] == main.prometheus_client.CONTENT_TYPE_LATEST
+    assert response.headers['content-type'].count('charset') == 1
+    assert b'recommendation_stage_latency_seconds' in response.content
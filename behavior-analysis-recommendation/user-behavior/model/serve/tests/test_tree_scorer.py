@@ -0,0 +1,76 @@
+"""
+CompiledTreeEnsemble与XGBoost predict_proba的一致性测试
+
+    cd model/serve && python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+xgb = pytest.importorskip('xgboost')
+
+from tree_scorer import CompiledTreeEnsemble  # noqa: E402
+
+TOLERANCE = 1e-5
+
+
+def _dataset(n_rows: int, n_features: int, seed: int, nan_rate: float = 0.1):
+    """带缺失值的二分类数据，标签依赖特征值和缺失与否"""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, n_features)).astype(np.float32)
+    logits = X[:, 0] - 0.5 * X[:, 1] + 0.25 * X[:, 2] * X[:, 3]
+    X[rng.random(X.shape) < nan_rate] = np.nan
+    logits = np.where(np.isnan(X[:, 0]), 1.0, logits)
+    y = (logits + rng.normal(scale=0.5, size=n_rows) > 0).astype(int)
+    return X, y
+
+
+@pytest.fixture(scope='module')
+def early_stopped_model():
+    """带缺失值、提前停止和非默认base_score训练的分类器"""
+    X, y = _dataset(4000, 8, seed=0)
+    X_val, y_val = _dataset(1000, 8, seed=1)
+    model = xgb.XGBClassifier(
+        n_estimators=300, max_depth=5, learning_rate=0.3, base_score=0.3,
+        early_stopping_rounds=5, eval_metric='logloss', random_state=0, n_jobs=1
+    )
+    model.fit(X, y, eval_set=[(X_val, y_val)], verbose=False)
+    assert model.best_iteration < 299, "early stopping did not trigger"
+    return model
+
+
+def test_predict_proba_parity_with_nans_and_early_stopping(early_stopped_model):
+    X, _ = _dataset(2000, 8, seed=2, nan_rate=0.2)
+    compiled = CompiledTreeEnsemble.from_xgboost(early_stopped_model)
+
+    expected = early_stopped_model.predict_proba(X)
+    actual = compiled.predict_proba(X)
+
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, atol=TOLERANCE)
+
+
+def test_all_missing_rows_follow_default_direction(early_stopped_model):
+    X = np.full((16, 8), np.nan, dtype=np.float32)
+    compiled = CompiledTreeEnsemble.from_xgboost(early_stopped_model)
+
+    np.testing.assert_allclose(
+        compiled.predict_proba(X), early_stopped_model.predict_proba(X), atol=TOLERANCE
+    )
+
+
+def test_saved_ensemble_keeps_parity(early_stopped_model, tmp_path):
+    X, _ = _dataset(500, 8, seed=3)
+    path = str(tmp_path / 'tree_ensemble.npz')
+    CompiledTreeEnsemble.from_xgboost(early_stopped_model).save(path)
+
+    loaded = CompiledTreeEnsemble.load(path)
+
+    np.testing.assert_allclose(
+        loaded.predict_proba(X), early_stopped_model.predict_proba(X), atol=TOLERANCE
+    )
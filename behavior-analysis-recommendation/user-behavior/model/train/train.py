@@ -304,26 +304,45 @@ class ModelManager:
         self.model_registry_path = model_registry_path
         self.models = {}
 
-    def save_model(self, model, model_name: str, version: str, metadata: Dict = None):
-        """保存模型到本地"""
+    def save_model(self, model, model_name: str, version: str, metadata: Dict = None,
+                   feature_names: Optional[List[str]] = None):
+        """保存模型到本地
+
+        先写入隐藏的临时目录，全部文件写完后放入完成标记（_SUCCESS），再整体rename
+        到版本目录，在线服务监听目录时不会读到写了一半的版本。
+        """
         import os
+        import shutil
 
         model_path = f"{self.model_registry_path}/{model_name}/{version}"
-        os.makedirs(model_path, exist_ok=True)
+        staging_path = f"{self.model_registry_path}/{model_name}/.{version}.tmp"
+        shutil.rmtree(staging_path, ignore_errors=True)
+        os.makedirs(staging_path)
 
         # 保存模型
         if model_name == 'xgboost':
-            joblib.dump(model, f"{model_path}/model.pkl")
+            joblib.dump(model, f"{staging_path}/model.pkl")
         elif model_name == 'lightfm':
             import pickle
-            with open(f"{model_path}/model.pkl", 'wb') as f:
+            with open(f"{staging_path}/model.pkl", 'wb') as f:
                 pickle.dump(model, f)
 
+        # 保存特征名称（在线服务按此顺序组装特征矩阵）
+        feature_names = feature_names or (metadata or {}).get('feature_names')
+        if feature_names:
+            with open(f"{staging_path}/feature_names.json", 'w') as f:
+                json.dump(feature_names, f)
+
         # 保存元数据
         if metadata:
-            with open(f"{model_path}/metadata.json", 'w') as f:
+            with open(f"{staging_path}/metadata.json", 'w') as f:
                 json.dump(metadata, f)
 
+        open(f"{staging_path}/_SUCCESS", 'w').close()
+        if os.path.exists(model_path):
+            shutil.rmtree(model_path)
+        os.rename(staging_path, model_path)
+
         logger.info(f"Model saved to {model_path}")
         return model_path
 